@@ -8,6 +8,16 @@ from .multilevel import Multilevel
 import falcon
 import json
 
+# The algorithms by the name of their route
+ALGORITHMS = {
+    "leiden": Leiden,
+    "fastgreedy": FastGreedy,
+    "infomap": Infomap,
+    "labelpropagation": LabelPropagation,
+    "leadingeigenvector": LeadingEigenvector,
+    "multilevel": Multilevel,
+}
+
 class Algorithms(object):
     jobs = None
     algorithms = None
@@ -17,12 +27,12 @@ class Algorithms(object):
         self.algorithms = {}
 
         # Initialize the list of algorithms
-        self.algorithms["leiden"] = Leiden(jobs)
-        self.algorithms["fastgreedy"] = FastGreedy(jobs)
-        self.algorithms["infomap"] = Infomap(jobs)
-        self.algorithms["labelpropagation"] = LabelPropagation(jobs)
-        self.algorithms["leadingeigenvector"] = LeadingEigenvector(jobs)
-        self.algorithms["multilevel"] = Multilevel(jobs)
+        for name, algorithm_class in ALGORITHMS.items():
+            self.algorithms[name] = algorithm_class(jobs)
+
+        # Our jobs run in the worker pool
+        for name, algorithm in self.algorithms.items():
+            jobs.add_service(name, algorithm)
 
     def on_get(self, req: falcon.Request, resp: falcon.Response):
         resp.code = falcon.HTTP_200
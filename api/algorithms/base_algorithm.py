@@ -4,66 +4,284 @@ Algorithm base class
 
 from uuid import UUID
 import json
+import random
+import time
 
 import falcon
-from multiprocessing import Manager,Process
+import numpy as np
 
+from api import cache
+from api.edgelist import EdgeList, apply_delta, read_request_delta, read_request_edges
 from api.jobs import Jobs
+from api.parallel import parallel_map
+from api.pool import QueueFull
 import api.utils as utils
 
 class BaseAlgorithm():
     jobs = None
-    myjobs = {}
+    name = None
+    # Algorithms that give a different answer each run are only cached
+    # when the client supplies a seed
+    deterministic = True
+    # Algorithms that can start from a previous job's partition.  We keep the
+    # graphs of their jobs that ask for it, so that a later job can send just
+    # the changes
+    warm_start = False
+    # Whether the algorithm can use the previous partition itself, rather
+    # than just the previous graph
+    initial_membership = False
+    # The stochastic algorithms can run several seeded trials and keep the
+    # best partition.  These are the trials they run by default, and the
+    # scores they can pick the best by, the default first
+    trials = 1
+    scores = ('modularity',)
 
     def __init__(self, jobs: Jobs):
         self.jobs = jobs
-        self.manager = jobs.get_manager()
 
     def on_post(self, req: falcon.Request, resp: falcon.Response):
         """ Get data and arguments """
-        result = self.manager.dict()
-        status = self.manager.dict()
-
-        # Get our parameters
-        args = self.get_args(req)
+        # Don't bother reading the data if we can't take the job
+        if self.jobs.pool.is_full():
+            queue_full(resp, QueueFull(self.jobs.pool.retry_after))
+            return
 
         # We need to do the load here because we can't pass a stream to our
-        # child process
-        args['json_data'] = json.load(req.get_param('data').file)
+        # worker process.  The edges are read into a compact edge list
+        initial_membership = None
+        try:
+            args = self.get_request_args(req)
+            previous = req.get_param('previous')
+            start = time.perf_counter()
+            if previous is None:
+                edges = read_request_edges(req)
+            else:
+                args['previous'] = previous
+                (edges, initial_membership) = self.get_warm_start(previous, req)
+            parse_seconds = time.perf_counter() - start
+        except ValueError as e:
+            bad_request(resp, str(e))
+            return
+        keep_graph = self.warm_start and utils.get_param_as_bool(req, 'keep_graph', False)
 
-        uuid = self.jobs.create_job(req.path, self)
-        proc = Process(target=self.community_detection, args=(args, status, result))
-        self.myjobs[uuid] = (proc, status, result)
-        proc.start()
+        try:
+            uuid = self.start_job(req.path, args, edges, initial_membership, parse_seconds,
+                                  keep_graph)
+        except QueueFull as e:
+            queue_full(resp, e)
+            return
         resp.code = falcon.HTTP_200
         resp.body = json.dumps({'job_id': str(uuid)})
 
+    def get_request_args(self, req) -> dict:
+        """ Get our arguments, along with the output options every algorithm
+            takes.  Raises ValueError if they are bad """
+        args = self.get_args(req)
+        args['output'] = utils.get_param_as_string(req, 'output', 'partitions')
+        if args['output'] not in utils.OUTPUTS:
+            raise ValueError('output must be one of '+', '.join(utils.OUTPUTS))
+        args['names'] = utils.get_param_as_bool(req, 'names', True)
+        if not self.deterministic:
+            self.get_trial_args(req, args)
+        return args
+
+    def get_trial_args(self, req: falcon.Request, args: dict):
+        """ Add the seeds of the trials to run, if we are to run several:
+            the seeds given, or that many from seed on.  Without a seed we
+            choose one, and return the seeds so that the result can be
+            reproduced.  Raises ValueError if they are bad """
+        trials = utils.get_param_as_int(req, 'trials', self.trials)
+        if req.has_param('seeds'):
+            try:
+                seeds = [int(value) for values in req.get_param_as_list('seeds')
+                         for value in values.split(',') if value.strip()]
+            except ValueError:
+                raise ValueError('seeds must be a comma separated list of integers')
+            # The same seeds give the same result, so it may be cached
+            args['seeds_given'] = True
+        elif trials > 1:
+            first = args.get('seed')
+            if first is None:
+                first = random.randrange(1 << 31)
+            seeds = [first + trial for trial in range(trials)]
+        elif trials < 1:
+            raise ValueError('trials must be at least 1')
+        else:
+            return
+        if not seeds:
+            raise ValueError('seeds must be a comma separated list of integers')
+        args['seeds'] = seeds
+        args['select'] = utils.get_param_as_string(req, 'select', self.scores[0])
+        if args['select'] not in self.scores:
+            raise ValueError('select must be one of '+', '.join(self.scores))
+        args['stability'] = utils.get_param_as_bool(req, 'stability', False)
+
+    def get_warm_start(self, previous: str, req: falcon.Request) -> tuple:
+        """ Apply the changes in the request to the graph of a previous job,
+            and get that job's partition to start from, if we can use it.
+            Returns (edges, initial membership or None) """
+        if not self.warm_start:
+            raise ValueError(self.name+' can not start from a previous job')
+        try:
+            previous_uuid = UUID(previous)
+        except ValueError:
+            raise ValueError('previous must be a job id')
+        (state, result) = self.jobs.get_result(previous_uuid)
+        if state != 'done' or result is None:
+            raise ValueError('previous job '+previous+' is not done')
+        previous_edges = self.jobs.load_edges(previous_uuid)
+        if previous_edges is None:
+            raise ValueError('the graph of previous job '+previous+' was not kept')
+        (added, removed) = read_request_delta(req)
+        edges = apply_delta(previous_edges, added, removed)
+        if not self.initial_membership:
+            return (edges, None)
+        membership = utils.get_result_membership(result, previous_edges.names)
+        # New nodes start out in clusters of their own
+        new_nodes = edges.node_count() - len(membership)
+        first = membership.max() + 1 if len(membership) > 0 else 0
+        membership = np.concatenate((membership, first + np.arange(new_nodes)))
+        return (edges, membership.astype(np.int32))
+
+    def start_job(self, url: str, args: dict, edges: EdgeList,
+                  initial_membership: np.ndarray = None, parse_seconds: float = None,
+                  keep_graph: bool = False) -> UUID:
+        """ Queue a job to run on edges, or if we've done this before, create
+            one that is already done.  Raises QueueFull if we can't take it.
+            parse_seconds is how long it took to read the edges, if we know.
+            If keep_graph, the edges are kept so that a later job can warm
+            start from this one """
+        cache_key = self.get_cache_key(args, edges)
+        keep_edges = keep_graph and self.warm_start and self.jobs.keep_graphs
+        stats = {'nodes': edges.node_count(), 'edges': edges.edge_count(), 'timings': {}}
+        if parse_seconds is not None:
+            stats['timings']['parse'] = parse_seconds
+        if cache_key is not None:
+            result = self.jobs.cache.get(cache_key)
+            if result is not None:
+                stats['cached'] = True
+                return self.jobs.create_finished_job(url, self, result,
+                                                     edges if keep_edges else None, stats)
+
+        args['edges'] = edges
+        args['initial_membership'] = initial_membership
+        uuid = self.jobs.create_job(url, self)
+        if keep_edges:
+            self.jobs.save_edges(uuid, edges)
+        try:
+            self.jobs.submit(uuid, args, cache_key, stats)
+        except QueueFull:
+            self.jobs.remove_job(uuid)
+            raise
+        return uuid
+
+    def get_cache_key(self, args: dict, edges: EdgeList) -> str:
+        """ The key for our result in the result cache, or None if it
+            shouldn't be cached """
+        if not self.deterministic and args.get('seed') is None and not args.get('seeds_given'):
+            return None
+        return cache.get_key(self.name, args, edges)
+
+    def run(self, args: dict, status: dict, result: dict):
+        """ Run the job on a worker """
+        status['phase'] = 'build'
+        self.community_detection(args, status, result)
+
+    def community_detection(self, args: dict, status: dict, result: dict):
+        """ Build the graph and partition it with cluster, or if we were
+            given seeds, with the best of that many trials """
+        status['status'] = 'running'
+        utils.set_seed(args['seed'])
+
+        graph = utils.get_edge_list_graph(args['edges'])
+        status['phase'] = 'cluster'
+        if 'seeds' in args:
+            part = self.run_trials(graph, args, result)
+        else:
+            part = self.cluster(graph, args)
+
+        status['phase'] = 'partition'
+        utils.add_partition(result, graph, part, args['output'])
+
+        status['status'] = 'done'
+
+    def cluster(self, graph, args: dict):
+        """ Partition the graph, returning a VertexClustering """
+        raise NotImplementedError
+
+    def run_trials(self, graph, args: dict, result: dict):
+        """ Partition the graph once per seed, in parallel, and return the
+            best partition by args['select'].  The score and size of every
+            trial go into the result, along with the stability of the
+            partitions if it was asked for """
+        select = args['select']
+        def trial(seed: int) -> tuple:
+            utils.set_seed(seed)
+            part = self.cluster(graph, args)
+            return (np.asarray(part.membership, dtype=np.int32), self.get_score(graph, part, select))
+        runs = parallel_map(trial, args['seeds'])
+
+        scores = [score for (membership, score) in runs]
+        # The shortest description, or the highest modularity
+        best = int(np.argmin(scores) if select == 'codelength' else np.argmax(scores))
+        result['trials'] = [{'seed': seed, select: score,
+                             'clusters': int(membership.max()) + 1 if len(membership) > 0 else 0}
+                            for (seed, (membership, score)) in zip(args['seeds'], runs)]
+        result['best_seed'] = args['seeds'][best]
+        if args['stability']:
+            result['stability'] = utils.get_stability(args['edges'].get_edges(),
+                                                      [membership for (membership, score) in runs])
+        return utils.ig.VertexClustering(graph, runs[best][0].tolist())
+
+    def get_score(self, graph, part, select: str) -> float:
+        """ How good a partition is, by one of our scores """
+        if select == 'codelength':
+            return part.codelength
+        return graph.modularity(part.membership, weights="weights")
+
+    def encode_result(self, args: dict, result: dict) -> bytes:
+        """ Encode a finished job's result for the result file """
+        if not args.get('names', True):
+            result.pop('nodes', None)
+        if args.get('output') == 'binary' and 'membership' in result:
+            return utils.get_binary_membership(result.get('nodes'), result['membership'])
+        return json.dumps(result).encode()
+
     def get_status(self, uid: UUID) -> str:
-        if uid in self.myjobs:
-            (proc, status, result) = self.myjobs[uid]
-            return status['status']
-        return None
+        return self.jobs.check_job(uid)
 
     def fetch_results(self, uid: UUID, req: falcon.Request, resp: falcon.Response):
-        if uid in self.myjobs:
-            (proc, status, result) = self.myjobs[uid]
+        (status, result) = self.jobs.get_result(uid)
+        if result is not None and result.startswith(utils.MEMBERSHIP_MAGIC):
+            # A binary result speaks for itself
+            resp.data = result
+            resp.content_type = utils.MEMBERSHIP_TYPE
+            resp.code = falcon.HTTP_200
+        elif status is not None:
             # Add our response
-            resp.body = utils.get_json_result(status, result)
+            resp.data = utils.get_json_result({'status': status,
+                                               'stats': self.jobs.get_stats(uid)}, result)
             resp.code = falcon.HTTP_200
         else:
             resp.code = falcon.HTTP_400
             resp.body = str({'error':"no such job: "+str(uid)})
 
     def terminate(self, uid: UUID, req: falcon.Request, resp: falcon.Response):
-        # Terminate the running process
-        if uid in self.myjobs:
-            (proc, status, result) = self.myjobs[uid]
-            proc.terminate()
-            self.jobs.remove_job(uid)
-            del self.myjobs[uid]
+        # Dequeue the job, or kill the worker running it
+        if self.jobs.terminate(uid):
             resp.body = "Job: "+str(uid)+" terminated"
             resp.code = falcon.HTTP_200
         else:
             resp.code = falcon.HTTP_400
             resp.body = str({'error':"no such job: "+str(uid)})
 
+def queue_full(resp: falcon.Response, error: QueueFull):
+    """ Tell the client to come back later """
+    resp.status = falcon.HTTP_503
+    resp.set_header('Retry-After', str(error.retry_after))
+    resp.body = json.dumps({'error': str(error)})
+
+def bad_request(resp: falcon.Response, error: str):
+    """ Tell the client what was wrong with the request """
+    resp.status = falcon.HTTP_400
+    resp.body = json.dumps({'error': error})
@@ -14,13 +14,15 @@ class FastGreedy(BaseAlgorithm):
         status['status'] = 'running'
 
         # Get our parameters
-        data = args['json_data']
+        edges = args['edges']
 
         # Get our data file
-        graph = utils.get_graph(data)
+        graph = utils.get_edge_list_graph(edges)
+        status['phase'] = 'cluster'
         part = graph.community_fastgreedy(weights="weights")
 
-        result['partitions'] = utils.get_vertex_list(graph, part.as_clustering())
+        status['phase'] = 'partition'
+        utils.add_partition(result, graph, part.as_clustering(), args['output'])
 
         status['status'] = 'done'
 
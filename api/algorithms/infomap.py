@@ -6,23 +6,16 @@ import api.utils as utils
 from .base_algorithm import BaseAlgorithm
 
 class Infomap(BaseAlgorithm):
+    deterministic = False
+    # igraph's own trials all run in the worker, one after another.  We run
+    # them as our trials instead, so that they are spread over its cores
+    trials = 10
+    scores = ('codelength', 'modularity')
+
     def get_args(self, req: falcon.Request) -> dict:
         args = {}
-        args['trials'] = utils.get_param_as_int(req, 'trials', 10)
+        args['seed'] = utils.get_param_as_int(req, 'seed', None)
         return args
 
-    def community_detection(self, args:dict, status:dict, result:dict):
-        status['status'] = 'running'
-
-        # Get our parameters
-        trials = args['trials']
-        data = args['json_data']
-
-        graph = utils.get_graph(data)
-
-        part = graph.community_infomap(edge_weights="weights", trials=trials)
-
-        result['partitions'] = utils.get_vertex_list(graph, part)
-
-        status['status'] = 'done'
-
+    def cluster(self, graph, args: dict):
+        return graph.community_infomap(edge_weights="weights", trials=1)
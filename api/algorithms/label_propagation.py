@@ -6,21 +6,13 @@ import api.utils as utils
 from .base_algorithm import BaseAlgorithm
 
 class LabelPropagation(BaseAlgorithm):
+    deterministic = False
+
     def get_args(self, req: falcon.Request) -> dict:
         """ Get data and arguments """
-        return {}
-
-    def community_detection(self, args:dict, status:dict, result:dict):
-        status['status'] = 'running'
-
-        # Get our parameters
-        data = args['json_data']
-
-        # Get our data file
-        graph = utils.get_graph(data)
-        part = graph.community_label_propagation(weights="weights")
-
-        result['partitions'] = utils.get_vertex_list(graph, part)
-
-        status['status'] = 'done'
+        args = {}
+        args['seed'] = utils.get_param_as_int(req, 'seed', None)
+        return args
 
+    def cluster(self, graph, args: dict):
+        return graph.community_label_propagation(weights="weights")
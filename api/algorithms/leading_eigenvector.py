@@ -13,13 +13,15 @@ class LeadingEigenvector(BaseAlgorithm):
         status['status'] = 'running'
 
         # Get our parameters
-        data = args['json_data']
+        edges = args['edges']
 
         # Get our data file
-        graph = utils.get_graph(data)
+        graph = utils.get_edge_list_graph(edges)
+        status['phase'] = 'cluster'
         part = graph.community_leading_eigenvector(weights="weights")
 
-        result['partitions'] = utils.get_vertex_list(graph, part)
+        status['phase'] = 'partition'
+        utils.add_partition(result, graph, part, args['output'])
 
         status['status'] = 'done'
 
@@ -3,10 +3,15 @@ Leiden cluster algorithm
 """
 
 import falcon
+import numpy as np
 import api.utils as utils
+from api.parallel import parallel_map
 from .base_algorithm import BaseAlgorithm
 
 class Leiden(BaseAlgorithm):
+    deterministic = False
+    warm_start = True
+    initial_membership = True
 
     def get_args(self, req: falcon.Request) -> dict:
         """ Get the arguments """
@@ -17,25 +22,102 @@ class Leiden(BaseAlgorithm):
         args['resolution_parameter'] = utils.get_param_as_float(req, 'resolution', 1.0)
         args['beta'] = utils.get_param_as_float(req, 'beta', 0.01)
         args['iterations'] = utils.get_param_as_int(req, 'iterations', 2)
+        args['seed'] = utils.get_param_as_int(req, 'seed', None)
+        # Several resolutions at once, on the same graph
+        if req.has_param('resolutions'):
+            args['resolutions'] = get_resolutions(req)
+            args['consensus'] = utils.get_param_as_bool(req, 'consensus', False)
+            args['consensus_threshold'] = utils.get_param_as_float(req, 'consensus_threshold', 0.5)
+        return args
+
+    def get_request_args(self, req: falcon.Request) -> dict:
+        args = super().get_request_args(req)
+        if 'resolutions' in args and args['output'] == 'binary':
+            raise ValueError('binary output takes a single resolution')
+        if 'resolutions' in args and 'seeds' in args:
+            raise ValueError('trials take a single resolution')
         return args
 
     def community_detection(self, args:dict, status:dict, result:dict):
+        if 'resolutions' not in args:
+            super().community_detection(args, status, result)
+            return
+
         status['status'] = 'running'
+        utils.set_seed(args['seed'])
 
-        # Get our parameters
-        obj_func = args['obj_func']
-        resolution_parameter = args['resolution_parameter']
-        beta = args['beta']
-        iterations = args['iterations']
-        data = args['json_data']
+        graph = utils.get_edge_list_graph(args['edges'])
+        status['phase'] = 'cluster'
+        self.multi_resolution(args, graph, status, result)
 
-        graph = utils.get_graph(data)
+        status['status'] = 'done'
 
-        part = graph.community_leiden(objective_function=obj_func, weights="weights",
-                                      resolution_parameter=resolution_parameter, beta=beta,
-                                      n_iterations=iterations)
+    def cluster(self, graph, args: dict, resolution: float = None):
+        if resolution is None:
+            resolution = args['resolution_parameter']
+        # Refine a previous partition if we were given one
+        initial_membership = args.get('initial_membership')
+        if initial_membership is not None:
+            initial_membership = initial_membership.tolist()
+        return graph.community_leiden(objective_function=args['obj_func'], weights="weights",
+                                      resolution_parameter=resolution, beta=args['beta'],
+                                      initial_membership=initial_membership,
+                                      n_iterations=args['iterations'])
 
-        result['partitions'] = utils.get_vertex_list(graph, part)
+    def multi_resolution(self, args: dict, graph, status: dict, result: dict):
+        """ Cluster the graph at each of the resolutions, in parallel, and
+            optionally find the consensus of the partitions """
+        def cluster(resolution: float) -> tuple:
+            # Each resolution is seeded alike, whichever process runs it
+            utils.set_seed(args['seed'])
+            part = self.cluster(graph, args, resolution)
+            return (np.asarray(part.membership, dtype=np.int32), part.quality,
+                    graph.modularity(part.membership, weights="weights"))
+        runs = parallel_map(cluster, args['resolutions'])
 
-        status['status'] = 'done'
+        status['phase'] = 'partition'
+        names = graph.vs['name']
+        result['resolutions'] = []
+        for (resolution, (membership, quality, modularity)) in zip(args['resolutions'], runs):
+            entry = {'resolution': resolution, 'quality': quality, 'modularity': modularity}
+            add_membership(entry, names, membership, args['output'])
+            result['resolutions'].append(entry)
+        if args['consensus']:
+            membership = get_consensus(args['edges'].get_edges(),
+                                       [membership for (membership, quality, modularity) in runs],
+                                       args['consensus_threshold'])
+            result['consensus'] = {'threshold': args['consensus_threshold'],
+                                   'modularity': graph.modularity(membership.tolist(),
+                                                                  weights="weights")}
+            add_membership(result['consensus'], names, membership, args['output'])
+        if args['output'] == 'membership':
+            # One name table for all of them
+            result['nodes'] = names
+
+def get_resolutions(req: falcon.Request) -> list:
+    """ The resolutions, given as a comma separated list, repeated
+        parameters or both """
+    try:
+        resolutions = [float(value) for values in req.get_param_as_list('resolutions')
+                       for value in values.split(',') if value.strip()]
+    except ValueError:
+        raise ValueError('resolutions must be a comma separated list of numbers')
+    if not resolutions:
+        raise ValueError('resolutions must be a comma separated list of numbers')
+    return resolutions
+
+def add_membership(entry: dict, names: list, membership: np.ndarray, output: str):
+    """ Add a partition to one entry of a multi-resolution result """
+    entry['clusters'] = int(membership.max()) + 1 if len(membership) > 0 else 0
+    if output == 'partitions':
+        entry['partitions'] = utils.get_partitions(names, membership)
+    else:
+        entry['membership'] = membership.tolist()
 
+def get_consensus(edges: np.ndarray, memberships: list, threshold: float) -> np.ndarray:
+    """ The consensus of several partitions: the connected components of the
+        edges whose ends are in the same cluster in at least threshold of the
+        partitions """
+    kept = edges[utils.get_co_assignment(edges, memberships) >= threshold]
+    return np.asarray(utils.ig.Graph(n=len(memberships[0]), edges=kept)
+                      .connected_components().membership, dtype=np.int32)
@@ -6,20 +6,15 @@ import api.utils as utils
 from .base_algorithm import BaseAlgorithm
 
 class Multilevel(BaseAlgorithm):
-    def get_args(self, req: falcon.Request) -> dict:
-        return {}
-
-    def community_detection(self, args:dict, status:dict, result:dict):
-        status['status'] = 'running'
-
-        # Get our parameters
-        data = args['json_data']
+    deterministic = False
+    # igraph's multilevel can't start from a partition, but it can still
+    # start from the previous graph rather than a new upload
+    warm_start = True
 
-        # Get our data file
-        graph = utils.get_graph(data)
-        part = graph.community_multilevel(weights="weights")
-
-        result['partitions'] = utils.get_vertex_list(graph, part)
-
-        status['status'] = 'done'
+    def get_args(self, req: falcon.Request) -> dict:
+        args = {}
+        args['seed'] = utils.get_param_as_int(req, 'seed', None)
+        return args
 
+    def cluster(self, graph, args: dict):
+        return graph.community_multilevel(weights="weights")
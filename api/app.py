@@ -1,36 +1,53 @@
 import falcon
 from falcon_multipart.middleware import MultipartMiddleware
-from multiprocessing import Manager
-from .scnetviz import ScNetVizHandler
+from .datasets import DatasetCache
+from .scnetviz import SERVICES, ScNetVizHandler
 from .algorithms.algorithms import Algorithms
+from .batch import Batch
 from .jobs import Jobs
+from .metrics import Metrics, MetricsMiddleware
 
-manager = None
+def create_app(mgr = None):
+    """ Create the falcon application.  The mgr argument is no longer used
+        and is only kept for older wsgi scripts """
+    metrics = Metrics()
+    api = falcon.API(middleware=[MultipartMiddleware(), MetricsMiddleware(metrics)])
 
-def create_app(mgr: Manager):
-    manager = mgr
-    api = falcon.API(middleware=[MultipartMiddleware()])
+    jobs = Jobs(metrics=metrics)
 
-    # Provided for backwards compatibility
-    api.add_route('/scnetviz/api/v1/umap', ScNetVizHandler())
-    api.add_route('/scnetviz/api/v1/tsne', ScNetVizHandler())
-    api.add_route('/scnetviz/api/v1/drawgraph', ScNetVizHandler())
-    api.add_route('/scnetviz/api/v1/louvain', ScNetVizHandler())
-    api.add_route('/scnetviz/api/v1/leiden', ScNetVizHandler())
+    # The scnetviz operations run as jobs too.  The original routes are
+    # provided for backwards compatibility, and wait for the job
+    datasets = DatasetCache()
+    for operation, service_class in SERVICES.items():
+        service = service_class(jobs, datasets)
+        jobs.add_service('scnetviz_'+operation, service)
+        api.add_route('/scnetviz/service/'+operation, service)
+        api.add_route('/scnetviz/api/v1/'+operation, ScNetVizHandler(service))
 
     # New API
-    jobs = Jobs(mgr)
     api.add_route('/status/{job_id}', jobs)
+    api.add_route('/events/{job_id}', jobs)
     api.add_route('/fetch/{job_id}', jobs)
     api.add_route('/terminate/{job_id}', jobs)
+    api.add_route('/jobs', jobs)
+    api.add_route('/stats', jobs)
+    api.add_route('/metrics', jobs)
     algorithms = Algorithms(jobs)
     api.add_route('/services', algorithms)
     for algorithm in algorithms.get_algorithms():
         api.add_route('/service/'+algorithm, algorithms.get_algorithm(algorithm))
+    batch = Batch(jobs, algorithms)
+    api.add_route('/batch', batch)
+    api.add_route('/batch/{batch_id}', batch)
+    api.add_route('/batch/{batch_id}/fetch', batch, suffix='fetch')
+    api.add_route('/batch/{batch_id}/terminate', batch, suffix='terminate')
+
+    # Fork the workers now that everything they need is in place
+    jobs.start()
 
     return api
 
 
 def get_app():
-    return create_app(Manager())
+    return create_app()
 
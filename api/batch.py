@@ -0,0 +1,196 @@
+"""
+Batches: many jobs from one request, such as a sweep over a parameter or a
+set of subnetworks, with each graph uploaded and parsed only once
+"""
+
+import json
+import time
+from uuid import UUID
+import uuid
+
+import falcon
+
+from .algorithms.algorithms import Algorithms
+from .algorithms.base_algorithm import bad_request, queue_full
+from .edgelist import iter_request_edge_lists
+from .job import FINISHED
+from .jobs import Jobs
+from .pool import QueueFull
+import api.utils as utils
+
+class ItemParams:
+    """ The parameters of one batch item.  This looks enough like a
+        falcon.Request that the algorithms' get_args can read them """
+    def __init__(self, params: dict):
+        self.params = params
+
+    def has_param(self, name: str) -> bool:
+        return name in self.params
+
+    def get_param(self, name: str, default = None):
+        return self.params.get(name, default)
+
+    def get_param_as_int(self, name: str) -> int:
+        return int(self.params[name])
+
+    def get_param_as_float(self, name: str) -> float:
+        return float(self.params[name])
+
+    def get_param_as_bool(self, name: str) -> bool:
+        value = self.params[name]
+        if isinstance(value, str):
+            return value.lower() in ('true', 'yes', 'on', '1')
+        return bool(value)
+
+    def get_param_as_list(self, name: str) -> list:
+        value = self.params[name]
+        if isinstance(value, list):
+            return [str(item) for item in value]
+        return [str(value)]
+
+class Batch:
+    """ Handles POST /batch, and GET /batch/{batch_id} (the state of each job),
+        /batch/{batch_id}/fetch (all of the results) and
+        /batch/{batch_id}/terminate.  The graphs are the 'data' parts of the
+        form (or a binary edge list as the body), and 'items' is a JSON list
+        of {"algorithm": name, "params": {...}, "graph": index} """
+    def __init__(self, jobs: Jobs, algorithms: Algorithms):
+        self.jobs = jobs
+        self.algorithms = algorithms
+
+    def on_post(self, req: falcon.Request, resp: falcon.Response):
+        pool = self.jobs.pool
+        try:
+            items = self.get_items(req)
+            # A batch that can't fit even in an empty queue will never be
+            # taken, so there's no point in the client coming back later
+            if len(items) > pool.max_queued:
+                resp.status = falcon.HTTP_413
+                resp.body = json.dumps({'error': 'a batch may have at most %d items' %
+                                                 pool.max_queued})
+                return
+            # Don't bother reading the data if we can't take the whole batch
+            if pool.queued() + len(items) > pool.max_queued:
+                queue_full(resp, QueueFull(pool.retry_after))
+                return
+            # Each job's stats get the time it took to read its graph
+            edge_lists = []
+            parse_seconds = []
+            start = time.perf_counter()
+            for edges in iter_request_edge_lists(req):
+                edge_lists.append(edges)
+                parse_seconds.append(time.perf_counter() - start)
+                start = time.perf_counter()
+            for (algorithm, args, graph) in items:
+                if graph < 0 or graph >= len(edge_lists):
+                    raise ValueError('no graph '+str(graph)+' in the data')
+        except ValueError as e:
+            bad_request(resp, str(e))
+            return
+
+        job_uuids = []
+        try:
+            for (algorithm, args, graph) in items:
+                job_uuids.append(algorithm.start_job(req.path, args, edge_lists[graph],
+                                                     parse_seconds=parse_seconds[graph]))
+        except QueueFull as e:
+            for job_uuid in job_uuids:
+                self.jobs.terminate(job_uuid)
+            queue_full(resp, e)
+            return
+
+        batch_uuid = uuid.uuid4()
+        self.jobs.store.create_batch(batch_uuid, job_uuids)
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps({'batch_id': str(batch_uuid),
+                                'job_ids': [str(job_uuid) for job_uuid in job_uuids]})
+
+    def get_items(self, req: falcon.Request) -> list:
+        """ Get (algorithm, args, graph index) for each item.  Raises
+            ValueError if they are bad """
+        try:
+            items = json.loads(req.get_param('items') or '')
+        except ValueError:
+            raise ValueError('items must be a JSON list')
+        if not isinstance(items, list) or len(items) == 0:
+            raise ValueError('items must be a non-empty JSON list')
+        result = []
+        for item in items:
+            if not isinstance(item, dict):
+                raise ValueError('each item must be a JSON object')
+            algorithm = self.algorithms.get_algorithm(item.get('algorithm'))
+            if algorithm is None:
+                raise ValueError('no such algorithm: '+str(item.get('algorithm')))
+            params = item.get('params', {})
+            if not isinstance(params, dict):
+                raise ValueError('params must be a JSON object')
+            if 'previous' in params:
+                # The data are whole graphs, not the changes to a previous one
+                raise ValueError('batch items can not warm start from a previous job')
+            graph = item.get('graph', 0)
+            if not isinstance(graph, int):
+                raise ValueError('graph must be an index into the data')
+            result.append((algorithm, algorithm.get_request_args(ItemParams(params)), graph))
+        return result
+
+    def on_get(self, req: falcon.Request, resp: falcon.Response, batch_id: str):
+        """ The state of the batch and of each of its jobs """
+        job_uuids = self.get_batch(batch_id)
+        if job_uuids is None:
+            bad_request(resp, 'No such batch')
+            return
+        states = [self.jobs.check_job(job_uuid) for job_uuid in job_uuids]
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps({'status': get_batch_status(states),
+                                'jobs': [{'job_id': str(job_uuid), 'status': state}
+                                         for (job_uuid, state) in zip(job_uuids, states)]})
+
+    def on_get_fetch(self, req: falcon.Request, resp: falcon.Response, batch_id: str):
+        """ All of the results, in order.  Binary results can only be fetched
+            one at a time from /fetch/{job_id}, so they are left out """
+        job_uuids = self.get_batch(batch_id)
+        if job_uuids is None:
+            bad_request(resp, 'No such batch')
+            return
+        states = []
+        results = []
+        for job_uuid in job_uuids:
+            (state, result) = self.jobs.get_result(job_uuid)
+            states.append(state)
+            status = {'job_id': str(job_uuid), 'status': state,
+                      'stats': self.jobs.get_stats(job_uuid)}
+            if result is not None and result.startswith(utils.MEMBERSHIP_MAGIC):
+                status['binary'] = True
+                result = None
+            results.append(utils.get_json_result(status, result))
+        resp.status = falcon.HTTP_200
+        resp.data = (json.dumps({'status': get_batch_status(states)})[:-1].encode() +
+                     b', "results": [' + b', '.join(results) + b']}')
+
+    def on_get_terminate(self, req: falcon.Request, resp: falcon.Response, batch_id: str):
+        """ Terminate every job in the batch """
+        job_uuids = self.get_batch(batch_id)
+        if job_uuids is None:
+            bad_request(resp, 'No such batch')
+            return
+        for job_uuid in job_uuids:
+            self.jobs.terminate(job_uuid)
+        resp.status = falcon.HTTP_200
+        resp.body = "Batch: "+batch_id+" terminated"
+
+    def get_batch(self, batch_id: str) -> list:
+        try:
+            return self.jobs.store.get_batch(UUID(batch_id))
+        except ValueError:
+            return None
+
+def get_batch_status(states: list) -> str:
+    """ A batch is done once all of its jobs are, or failed if any of them
+        failed (or were removed), and otherwise running if any job is """
+    if all(state is None or state in FINISHED for state in states):
+        if all(state == 'done' for state in states):
+            return 'done'
+        return 'failed'
+    if 'running' in states:
+        return 'running'
+    return 'queued'
@@ -0,0 +1,158 @@
+"""
+A content-addressed cache of job results, so that resubmitting the same
+network with the same parameters doesn't recompute it
+"""
+
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from . import config
+from .edgelist import EdgeList
+from .metrics import Metrics
+
+def get_key(algorithm: str, params: dict, edge_list: EdgeList) -> str:
+    """ Hash the algorithm, its parameters and the edge list.  Since nodes are
+        numbered in the order they first appear, the name table and the id
+        and weight columns are a canonical form of the edges in the order
+        they were sent, regardless of how the upload was formatted """
+    digest = hashlib.sha256()
+    digest.update(algorithm.encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    digest.update(json.dumps(edge_list.names).encode())
+    digest.update(edge_list.get_edges().astype('<i4'))
+    digest.update(edge_list.get_weights().astype('<f8'))
+    return digest.hexdigest()
+
+class ResultCache:
+    """ An in-memory LRU cache of encoded results, optionally backed by a
+        directory that all of the web processes can share.  Both tiers are
+        bounded by the total size of the results they hold """
+    hits = 0
+    misses = 0
+
+    def __init__(self, max_bytes: int = None, directory: str = None, max_disk_bytes: int = None,
+                 metrics: Metrics = None):
+        if max_bytes is None:
+            max_bytes = config.get_int('CACHE_MAX_BYTES', 256 << 20)
+        self.max_bytes = max_bytes
+        self.directory = directory or config.get_string('CACHE_DIR', None)
+        self.max_disk_bytes = max_disk_bytes or config.get_int('CACHE_MAX_DISK_BYTES', 4 << 30)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key: str) -> bytes:
+        """ Get a cached result, or None """
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.count('restapi_cache_hits_total', 'memory')
+                return result
+        result = self._get_disk(key)
+        with self.lock:
+            if result is None:
+                self.misses += 1
+                self.count('restapi_cache_misses_total')
+                return None
+            self.hits += 1
+            self.count('restapi_cache_hits_total', 'disk')
+            self._add(key, result)
+        return result
+
+    def count(self, name: str, tier: str = None):
+        if self.metrics is not None:
+            self.metrics.inc(name, {'tier': tier} if tier is not None else None)
+
+    def put(self, key: str, path: str):
+        """ Cache the result stored at path.  A result too large for a tier
+            is left out of it without being read """
+        size = os.path.getsize(path)
+        if size <= self.max_bytes:
+            with open(path, 'rb') as f:
+                result = f.read()
+            with self.lock:
+                self._add(key, result)
+        if size <= self.max_disk_bytes:
+            self._put_disk(key, path)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'bytes': self.size}
+
+    def _add(self, key: str, result: bytes):
+        """ Add to the memory tier.  Called with the lock held """
+        if len(result) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = result
+        self.size += len(result)
+        while self.size > self.max_bytes:
+            (old_key, old_result) = self.entries.popitem(last=False)
+            self.size -= len(old_result)
+
+    def _get_disk(self, key: str) -> bytes:
+        if self.directory is None:
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as f:
+                result = f.read()
+        except FileNotFoundError:
+            return None
+        # Note the use for the LRU
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return result
+
+    def _put_disk(self, key: str, path: str):
+        if self.directory is None:
+            return
+        cached = os.path.join(self.directory, key)
+        tmp = cached+'.'+str(os.getpid())
+        try:
+            # The result file is never modified, so we can share it
+            os.link(path, tmp)
+        except OSError:
+            with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        os.replace(tmp, cached)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        """ Remove the least recently used results until we fit """
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            # Skip anything still being written
+            if '.' in entry.name:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        files.sort()
+        for (mtime, size, path) in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
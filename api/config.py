@@ -0,0 +1,29 @@
+"""
+Service configuration.  Every setting can be overridden from the environment
+by prefixing its name with RESTAPI_, e.g. RESTAPI_POOL_WORKERS=8
+"""
+
+import os
+
+PREFIX = 'RESTAPI_'
+
+def get_string(name: str, default: str) -> str:
+    return os.environ.get(PREFIX+name, default)
+
+def get_int(name: str, default: int) -> int:
+    value = os.environ.get(PREFIX+name)
+    if value is None or value == '':
+        return default
+    return int(value)
+
+def get_float(name: str, default: float) -> float:
+    value = os.environ.get(PREFIX+name)
+    if value is None or value == '':
+        return default
+    return float(value)
+
+def get_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(PREFIX+name)
+    if value is None or value == '':
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
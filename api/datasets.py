@@ -0,0 +1,309 @@
+"""
+A cache of the single cell datasets uploaded to scnetviz, so that the same
+10x matrix isn't unzipped and parsed again for every request
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+from . import config
+from .lazy import LazyModule
+
+ad = LazyModule('anndata')
+h5py = LazyModule('h5py')
+pd = LazyModule('pandas')
+sc = LazyModule('scanpy')
+sparse = LazyModule('scipy.sparse')
+
+CHUNK_SIZE = 1 << 20
+# Matrix Market entries parsed at a time, and about the most entries in one
+# block of cells when the filtered matrix is written
+CHUNK_ENTRIES = 1 << 20
+BLOCK_ENTRIES = 1 << 22
+# An entry of a cell we keep, as sorted into the block files
+ENTRY = np.dtype([('cell', '<i4'), ('gene', '<i4'), ('value', '<f4')])
+
+def get_upload_hash(stream) -> str:
+    """ Hash an uploaded file, leaving it rewound for whoever reads it next """
+    digest = hashlib.sha256()
+    stream.seek(0)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def get_key(upload_hash: str, source: str, accession: str) -> str:
+    """ The cache key of a dataset: the archive's content plus where in it
+        the matrix is """
+    digest = hashlib.sha256()
+    for part in (upload_hash, source, accession):
+        digest.update(part.encode()+b'\0')
+    return digest.hexdigest()
+
+def get_stage_key(key: str, stage: str, params: dict) -> str:
+    """ The cache key of a processing stage applied with params to the
+        dataset (or earlier stage) with the given key """
+    digest = hashlib.sha256()
+    digest.update(key.encode()+b'\0'+stage.encode()+b'\0')
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+class DatasetCache:
+    """ Parsed datasets, and the stages of processing them, stored as h5ad
+        files in a directory that all of the web processes can share, least
+        recently used first out once they exceed max_bytes.  Each upload is
+        extracted into a directory of its own, so concurrent requests never
+        see each other's files """
+
+    def __init__(self, directory: str = None, max_bytes: int = None):
+        self.directory = directory or config.get_string('DATASET_DIR', '/tmp/restapi/datasets')
+        self.max_bytes = max_bytes or config.get_int('DATASET_MAX_BYTES', 4 << 30)
+        self.upload_ttl = config.get_float('DATASET_UPLOAD_TTL', 24*3600)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key+'.h5ad')
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self.get_path(key))
+
+    def save_upload(self, stream) -> str:
+        """ Copy an uploaded archive to a file of its own, for a worker to read """
+        (fd, path) = tempfile.mkstemp(suffix='.upload', dir=self.directory)
+        stream.seek(0)
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(stream, f, CHUNK_SIZE)
+        stream.seek(0)
+        return path
+
+    def remove_upload(self, path: str):
+        if path is None:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def load_upload(self, key: str, upload: str, source: str, accession: str,
+                    min_genes: int = 0, min_cells: int = 0):
+        """ Get a filtered dataset by key, reading it from the saved upload if
+            it isn't cached """
+        adata = self.load(key)
+        if adata is None:
+            if upload is None:
+                raise ValueError('the dataset was removed from the cache; please upload it again')
+            tmp = self.get_tmp_path(key)
+            try:
+                read_archive(upload, source, accession, tmp, min_genes, min_cells)
+                os.replace(tmp, self.get_path(key))
+            finally:
+                self.remove_upload(tmp)
+            self.evict()
+            adata = self.load(key)
+        return adata
+
+    def load(self, key: str):
+        """ Get a dataset, or a processed stage of one, or None if it isn't cached """
+        path = self.get_path(key)
+        try:
+            adata = sc.read_h5ad(path)
+        except (FileNotFoundError, OSError):
+            return None
+        # Note the use for the LRU
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return adata
+
+    def put(self, key: str, adata):
+        tmp = self.get_tmp_path(key)
+        adata.write_h5ad(tmp, compression='lzf')
+        os.replace(tmp, self.get_path(key))
+        self.evict()
+
+    def get_tmp_path(self, key: str) -> str:
+        """ Where this process writes a dataset before it is put in place """
+        return self.get_path(key)+'.'+str(os.getpid())+'.tmp'
+
+    def evict(self):
+        """ Remove the least recently used datasets until we fit, and any
+            uploads that were never read (because their job was terminated) """
+        files = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith('.upload') and stat.st_mtime < now - self.upload_ttl:
+                self.remove_upload(entry.path)
+            # Skip anything still being written
+            if not entry.name.endswith('.h5ad'):
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        files.sort()
+        for (mtime, size, path) in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def read_archive(matrix_file, source: str, accession: str, path: str,
+                 min_genes: int = 0, min_cells: int = 0):
+    """ Read the 10x matrix at source/accession in a zip archive into an h5ad
+        file at path, keeping the cells with at least min_genes genes and then
+        the genes in at least min_cells of those cells, as scanpy's
+        filter_cells and filter_genes would.  The matrix is streamed from the
+        archive twice, and the entries of the cells we keep are sorted into
+        blocks of cells on disk, so the unfiltered matrix is never in memory
+        and the filtered one only a block at a time """
+    directory = tempfile.mkdtemp(prefix='scnetviz-', dir=os.path.dirname(path) or None)
+    try:
+        with zipfile.ZipFile(matrix_file, 'r') as archive:
+            members = get_members(archive, source, accession)
+            (n_genes, n_cells) = read_mtx_shape(archive, members['matrix'])
+
+            # First pass: the genes in each cell
+            genes_per_cell = np.zeros(n_cells, dtype=np.int64)
+            for (genes, cells, values) in read_mtx_entries(archive, members['matrix']):
+                genes_per_cell += np.bincount(cells[values != 0], minlength=n_cells)
+            keep_cells = genes_per_cell >= min_genes
+            if not keep_cells.any():
+                raise ValueError('no cells have at least '+str(min_genes)+' genes')
+            cell_ids = np.full(n_cells, -1, dtype=np.int64)
+            cell_ids[keep_cells] = np.arange(keep_cells.sum())
+            # Each block of cells holds about BLOCK_ENTRIES entries
+            kept_genes = genes_per_cell[keep_cells]
+            cell_blocks = (np.cumsum(kept_genes) - kept_genes) // BLOCK_ENTRIES
+            block_starts = np.searchsorted(cell_blocks, np.arange(cell_blocks[-1]+2))
+
+            # Second pass: the cells we keep that each gene is in, while we
+            # sort their entries into the blocks
+            cells_per_gene = np.zeros(n_genes, dtype=np.int64)
+            for (genes, cells, values) in read_mtx_entries(archive, members['matrix']):
+                keep = (cell_ids[cells] >= 0) & (values != 0)
+                entries = np.empty(keep.sum(), dtype=ENTRY)
+                entries['cell'] = cell_ids[cells[keep]]
+                entries['gene'] = genes[keep]
+                entries['value'] = values[keep]
+                cells_per_gene += np.bincount(entries['gene'], minlength=n_genes)
+                blocks = cell_blocks[entries['cell']]
+                order = np.argsort(blocks, kind='stable')
+                (present, starts) = np.unique(blocks[order], return_index=True)
+                for (block, start, end) in zip(present, starts, np.append(starts[1:], len(order))):
+                    with open(os.path.join(directory, str(block)), 'ab') as f:
+                        entries[order[start:end]].tofile(f)
+            keep_genes = cells_per_gene >= min_cells
+            gene_ids = np.full(n_genes, -1, dtype=np.int64)
+            gene_ids[keep_genes] = np.arange(keep_genes.sum())
+
+            obs = read_barcodes(archive, members['barcodes'])[keep_cells]
+            obs['n_genes'] = genes_per_cell[keep_cells]
+            var = read_features(archive, members['features'])[keep_genes]
+            var['n_cells'] = cells_per_gene[keep_genes]
+
+        with h5py.File(path, 'w') as f:
+            f.attrs['encoding-type'] = 'anndata'
+            f.attrs['encoding-version'] = '0.1.0'
+            ad.io.write_elem(f, 'obs', obs)
+            ad.io.write_elem(f, 'var', var)
+            matrix = None
+            for block in range(len(block_starts)-1):
+                block_path = os.path.join(directory, str(block))
+                entries = (np.fromfile(block_path, dtype=ENTRY) if os.path.exists(block_path)
+                           else np.empty(0, dtype=ENTRY))
+                genes = gene_ids[entries['gene']]
+                keep = genes >= 0
+                rows = block_starts[block+1] - block_starts[block]
+                X = sparse.csr_matrix((entries['value'][keep],
+                                       (entries['cell'][keep] - block_starts[block], genes[keep])),
+                                      shape=(rows, len(var)), dtype=np.float32)
+                X.sort_indices()
+                if matrix is None:
+                    ad.io.write_elem(f, 'X', X, dataset_kwargs={'compression': 'lzf'})
+                    matrix = ad.io.sparse_dataset(f['X'])
+                else:
+                    matrix.append(X)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def get_members(archive, source: str, accession: str) -> dict:
+    """ The names in the archive of the matrix, barcodes and features (or
+        genes, in the older layout) at source/accession """
+    names = set(archive.namelist())
+    members = {}
+    for (member, candidates) in (('matrix', ('matrix.mtx.gz', 'matrix.mtx')),
+                                 ('barcodes', ('barcodes.tsv.gz', 'barcodes.tsv')),
+                                 ('features', ('features.tsv.gz', 'genes.tsv.gz', 'genes.tsv'))):
+        for candidate in candidates:
+            name = '/'.join((source, accession, candidate))
+            if name in names:
+                members[member] = name
+                break
+        else:
+            raise ValueError('no '+member+' in the archive at '+source+'/'+accession)
+    return members
+
+def open_member(archive, name: str):
+    f = archive.open(name)
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=f)
+    return f
+
+def read_mtx_header(f) -> tuple:
+    """ Read the header of a Matrix Market file, leaving f at the first entry.
+        Returns the number of rows (genes) and columns (cells) """
+    line = f.readline()
+    if not line.startswith(b'%%MatrixMarket matrix coordinate'):
+        raise ValueError('the matrix is not in Matrix Market coordinate format')
+    while line.startswith(b'%'):
+        line = f.readline()
+    (rows, columns, entries) = (int(value) for value in line.split())
+    return (rows, columns)
+
+def read_mtx_shape(archive, name: str) -> tuple:
+    with open_member(archive, name) as f:
+        return read_mtx_header(f)
+
+def read_mtx_entries(archive, name: str):
+    """ The (genes, cells, values) of a Matrix Market file, numbered from 0,
+        CHUNK_ENTRIES at a time """
+    with open_member(archive, name) as f:
+        read_mtx_header(f)
+        for chunk in pd.read_csv(f, sep=r'\s+', header=None, names=('gene', 'cell', 'value'),
+                                 dtype={'gene': np.int64, 'cell': np.int64, 'value': np.float32},
+                                 chunksize=CHUNK_ENTRIES):
+            yield (chunk['gene'].to_numpy() - 1, chunk['cell'].to_numpy() - 1,
+                   chunk['value'].to_numpy())
+
+def read_barcodes(archive, name: str):
+    with open_member(archive, name) as f:
+        barcodes = pd.read_csv(f, sep='\t', header=None, usecols=[0], dtype=str)[0]
+    return pd.DataFrame(index=pd.Index(barcodes.to_numpy(), dtype=str))
+
+def read_features(archive, name: str):
+    """ The genes, named by their symbols as read_10x_mtx does """
+    with open_member(archive, name) as f:
+        features = pd.read_csv(f, sep='\t', header=None, dtype=str)
+    var = pd.DataFrame({'gene_ids': features[0].to_numpy()},
+                       index=ad.utils.make_index_unique(pd.Index(features[1].to_numpy())))
+    if features.shape[1] > 2:
+        var['feature_types'] = features[2].to_numpy()
+    return var
@@ -0,0 +1,440 @@
+"""
+A compact edge list, and the readers for the formats that the clients
+upload it in: a streaming parser for JSON that never builds the whole
+document in memory, and a binary format that needs no parsing at all.
+
+The binary format (content type application/x-edgelist) is, with all
+numbers little-endian:
+
+    magic        4 bytes   b'RBEL'
+    version      uint32    1
+    flags        uint32    0, or 1 if the weights are float64
+    nodes        uint32    the number of nodes
+    edges        uint64    the number of edges
+    names size   uint64    the size of the name table in bytes
+    name table             the node names, UTF-8, each followed by a NUL,
+                           padded with NULs to a multiple of 8 bytes
+    sources      int32[edges]    node ids, indices into the name table
+    targets      int32[edges]
+    weights      float32[edges]  (or float64)
+
+The pool hands edge lists to its workers, and we keep the graphs that later
+jobs can warm start from, in files that are mapped rather than read.  They
+have the same layout, except that the name table is a JSON list, so that
+the names keep their types: JSON node ids may be numbers.
+"""
+
+from array import array
+import codecs
+import io
+import json
+import mmap
+import os
+import re
+import struct
+
+import numpy as np
+
+CHUNK_SIZE = 1 << 20
+
+BINARY_TYPE = 'application/x-edgelist'
+BINARY_MAGIC = b'RBEL'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sIIIQQ')
+# The weights are float64 rather than float32
+DOUBLE_WEIGHTS = 1
+
+# A mapped edge list: magic, flags, edges and the size of the JSON name table
+SHARED_MAGIC = b'RBSE'
+SHARED_HEADER = struct.Struct('<4sIQQ')
+
+# A JSON string or number
+VALUE = r'"[^"\\]*(?:\\.[^"\\]*)*"|-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?'
+# An [source, target, weight] edge and the separator that follows it.  The
+# weight is optional
+EDGE = re.compile(r'\s*\[\s*('+VALUE+r')\s*,\s*('+VALUE+r')\s*(?:,\s*('+VALUE+r')\s*)?\]\s*([,\]])')
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+SPACE = re.compile(r'\s*')
+# One token of a value we are skipping
+TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{},:]|[^"\[\]{},:\s]+')
+
+class EdgeList:
+    """ An edge list as a node name table plus int32 source and target
+        columns of indices into it and a float64 weight column.  Nodes are
+        numbered in the order they first appear, just as Graph.TupleList
+        numbers them """
+
+    def __init__(self, names: list = None, sources = None, targets = None, weights = None):
+        self.names = names if names is not None else []
+        self.sources = sources if sources is not None else array('i')
+        self.targets = targets if targets is not None else array('i')
+        self.weights = weights if weights is not None else array('d')
+
+    def node_count(self) -> int:
+        return len(self.names)
+
+    def edge_count(self) -> int:
+        return len(self.sources)
+
+    def get_edges(self) -> np.ndarray:
+        """ The edges as an (m, 2) array of node ids """
+        return np.column_stack((np.asarray(self.sources), np.asarray(self.targets)))
+
+    def get_weights(self) -> np.ndarray:
+        """ The weights, which may be float32 or float64, without copying """
+        return np.asarray(self.weights)
+
+class Scanner:
+    """ Reads a JSON document from a binary stream a chunk at a time """
+    def __init__(self, stream, chunk_size: int = CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """ Read the next chunk, dropping what we've consumed.  Returns False
+            at the end of the stream """
+        if self.eof:
+            return False
+        data = self.stream.read(self.chunk_size)
+        if isinstance(data, str):
+            data = data.encode()
+        self.eof = len(data) == 0
+        self.buffer = self.buffer[self.pos:]+self.decoder.decode(data, self.eof)
+        self.pos = 0
+        return True
+
+    def match(self, regex):
+        """ Match regex at the current position, making sure that the match
+            isn't cut short by the end of the buffer """
+        while True:
+            m = regex.match(self.buffer, self.pos)
+            if m is not None and (m.end() < len(self.buffer) or self.eof):
+                self.pos = m.end()
+                return m
+            if not self.fill():
+                if m is not None:
+                    self.pos = m.end()
+                return m
+
+    def skip_space(self):
+        while True:
+            self.pos = SPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.fill():
+                return
+
+    def peek(self) -> str:
+        self.skip_space()
+        return self.buffer[self.pos:self.pos+1]
+
+    def expect(self, chars: str) -> str:
+        """ Consume the next character, which must be one of chars """
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError("expected one of '"+chars+"' at '"+self.buffer[self.pos:self.pos+20]+"'")
+        self.pos += 1
+        return c
+
+    def read_string(self) -> str:
+        self.skip_space()
+        m = self.match(STRING)
+        if m is None:
+            raise ValueError("expected a string at '"+self.buffer[self.pos:self.pos+20]+"'")
+        return json.loads(m.group())
+
+    def skip_value(self):
+        depth = 0
+        while True:
+            self.skip_space()
+            m = self.match(TOKEN)
+            if m is None:
+                raise ValueError('unexpected end of data')
+            token = m.group()
+            if token in ('[', '{'):
+                depth += 1
+            elif token in (']', '}'):
+                depth -= 1
+            if depth == 0:
+                return
+
+def read_json_edges(stream, chunk_size: int = CHUNK_SIZE) -> EdgeList:
+    """ Read the edges from a {"nodes": [...], "edges": [[source, target, weight], ...]}
+        document.  The edges go straight into the compact columns, so we never
+        hold more than a chunk of the document, or any per-edge lists """
+    edge_lists = read_json_edge_lists(stream, ('edges',), chunk_size)
+    if 'edges' not in edge_lists:
+        raise ValueError('no edges in the data')
+    return edge_lists['edges']
+
+def read_json_delta(stream, chunk_size: int = CHUNK_SIZE) -> tuple:
+    """ Read the changes to a graph from a {"edges": [...], "removed": [...]}
+        document, as (added, removed) edge lists.  Either may be left out """
+    edge_lists = read_json_edge_lists(stream, ('edges', 'removed'), chunk_size)
+    return (edge_lists.get('edges', EdgeList()), edge_lists.get('removed', EdgeList()))
+
+def read_json_edge_lists(stream, keys: tuple, chunk_size: int = CHUNK_SIZE) -> dict:
+    """ Read the edge lists under each of keys in a JSON object, skipping
+        everything else """
+    scanner = Scanner(stream, chunk_size)
+    edge_lists = {}
+    scanner.expect('{')
+    if scanner.peek() == '}':
+        scanner.pos += 1
+    else:
+        while True:
+            key = scanner.read_string()
+            scanner.expect(':')
+            if key in keys:
+                edge_lists[key] = read_edges(scanner)
+            else:
+                scanner.skip_value()
+            if scanner.expect(',}') == '}':
+                break
+    return edge_lists
+
+def read_edges(scanner: Scanner) -> EdgeList:
+    """ Read the edges array """
+    edge_list = EdgeList()
+    # Node ids by the token as it appears in the document, which saves
+    # decoding it every time, and by name
+    ids = {}
+    name_ids = {}
+    names = edge_list.names
+    add_source = edge_list.sources.append
+    add_target = edge_list.targets.append
+    add_weight = edge_list.weights.append
+    get_id = ids.get
+
+    def add_node(token: str) -> int:
+        if token[0] == '"' and '\\' not in token:
+            name = token[1:-1]
+        else:
+            name = json.loads(token)
+        index = name_ids.get(name)
+        if index is None:
+            index = len(names)
+            name_ids[name] = index
+            names.append(name)
+        ids[token] = index
+        return index
+
+    scanner.expect('[')
+    if scanner.peek() == ']':
+        scanner.pos += 1
+        return edge_list
+
+    while True:
+        buffer = scanner.buffer
+        pos = scanner.pos
+        done = False
+        for m in EDGE.finditer(buffer, pos):
+            if m.start() != pos:
+                break
+            (source, target, weight, separator) = m.groups()
+            index = get_id(source)
+            add_source(index if index is not None else add_node(source))
+            index = get_id(target)
+            add_target(index if index is not None else add_node(target))
+            if weight is None:
+                add_weight(1.0)
+            elif weight[0] == '"':
+                add_weight(float(weight[1:-1]))
+            else:
+                add_weight(float(weight))
+            pos = m.end()
+            if separator == ']':
+                done = True
+                break
+        scanner.pos = pos
+        if done:
+            return edge_list
+        if not scanner.fill():
+            raise ValueError("bad edge at '"+scanner.buffer[scanner.pos:scanner.pos+40]+"'")
+
+def read_binary_edges(stream) -> EdgeList:
+    """ Read an edge list in our binary format.  The columns are numpy views
+        of the buffer we read the data into, so they aren't copied again """
+    header = read_exactly(stream, BINARY_HEADER.size)
+    (magic, version, flags, nodes, edges, names_size) = BINARY_HEADER.unpack(header)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError('not a version '+str(BINARY_VERSION)+' binary edge list')
+    if names_size % 8 != 0:
+        raise ValueError('name table is not padded to a multiple of 8 bytes')
+    weight_type = '<f8' if flags & DOUBLE_WEIGHTS else '<f4'
+    data = read_exactly(stream, names_size + edges*(4+4+np.dtype(weight_type).itemsize))
+    names = bytes(data[:names_size]).decode('utf-8').split('\0')
+    if len(names) <= nodes:
+        raise ValueError('name table has fewer than '+str(nodes)+' names')
+    offset = names_size
+    sources = np.frombuffer(data, dtype='<i4', count=edges, offset=offset)
+    offset += 4*edges
+    targets = np.frombuffer(data, dtype='<i4', count=edges, offset=offset)
+    offset += 4*edges
+    weights = np.frombuffer(data, dtype=weight_type, count=edges, offset=offset)
+    for ids in (sources, targets):
+        if edges > 0 and (ids.min() < 0 or ids.max() >= nodes):
+            raise ValueError('node id out of range')
+    return EdgeList(names[:nodes], sources, targets, weights)
+
+def write_shared_edges(edge_list: EdgeList, path: str):
+    """ Write an edge list to a new file that can be mapped, such as one for
+        the workers in /dev/shm.  Its space is allocated first, since running
+        out of it while writing to the mapping would be a SIGBUS rather than
+        an error.  Raises OSError if there isn't room """
+    names = json.dumps(edge_list.names, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    weights = np.asarray(edge_list.weights)
+    weight_type = '<f4' if weights.dtype == np.float32 else '<f8'
+    edges = edge_list.edge_count()
+    size = (SHARED_HEADER.size + len(names) + (-len(names) % 8) +
+            edges*(4+4+np.dtype(weight_type).itemsize))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+        with mmap.mmap(fd, size) as buffer:
+            SHARED_HEADER.pack_into(buffer, 0, SHARED_MAGIC,
+                                    DOUBLE_WEIGHTS if weight_type == '<f8' else 0,
+                                    edges, len(names))
+            offset = SHARED_HEADER.size
+            buffer[offset:offset+len(names)] = names
+            offset += len(names) + (-len(names) % 8)
+            for (column, dtype) in ((edge_list.sources, '<i4'), (edge_list.targets, '<i4'),
+                                    (weights, weight_type)):
+                np.frombuffer(buffer, dtype=dtype, count=edges, offset=offset)[:] = column
+                offset += edges*np.dtype(dtype).itemsize
+    except BaseException:
+        os.close(fd)
+        os.remove(path)
+        raise
+    os.close(fd)
+
+def read_shared_edges(path: str) -> EdgeList:
+    """ Map an edge list written by write_shared_edges.  The columns are
+        read-only views of the mapping, which is unmapped once they are gone,
+        so only the names are copied """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, flags, edges, names_size) = SHARED_HEADER.unpack_from(buffer, 0)
+    if magic != SHARED_MAGIC:
+        raise ValueError('not a shared edge list')
+    offset = SHARED_HEADER.size
+    names = json.loads(buffer[offset:offset+names_size].decode('utf-8'))
+    if not isinstance(names, list):
+        raise ValueError('not a shared edge list')
+    offset += names_size + (-names_size % 8)
+    weight_type = '<f8' if flags & DOUBLE_WEIGHTS else '<f4'
+    sources = np.frombuffer(buffer, dtype='<i4', count=edges, offset=offset)
+    offset += 4*edges
+    targets = np.frombuffer(buffer, dtype='<i4', count=edges, offset=offset)
+    offset += 4*edges
+    weights = np.frombuffer(buffer, dtype=weight_type, count=edges, offset=offset)
+    return EdgeList(names, sources, targets, weights)
+
+def apply_delta(edge_list: EdgeList, added: EdgeList, removed: EdgeList) -> EdgeList:
+    """ A new edge list with the removed edges (in either direction, since our
+        graphs are undirected) taken out and the added edges appended.  New
+        nodes go at the end of the name table, so the existing nodes keep their
+        ids and a membership vector for the old graph still lines up """
+    names = list(edge_list.names)
+    ids = {name: index for (index, name) in enumerate(names)}
+    sources = np.asarray(edge_list.sources, dtype=np.int64)
+    targets = np.asarray(edge_list.targets, dtype=np.int64)
+    weights = np.asarray(edge_list.weights, dtype=np.float64)
+
+    if removed.edge_count() > 0:
+        # Translate the removed edges into our ids, ignoring unknown nodes
+        table = np.array([ids.get(name, -1) for name in removed.names], dtype=np.int64)
+        removed_sources = table[np.asarray(removed.sources)]
+        removed_targets = table[np.asarray(removed.targets)]
+        known = (removed_sources >= 0) & (removed_targets >= 0)
+        count = len(names)
+        def get_keys(a, b):
+            return np.minimum(a, b)*count + np.maximum(a, b)
+        keep = ~np.isin(get_keys(sources, targets),
+                        get_keys(removed_sources[known], removed_targets[known]))
+        (sources, targets, weights) = (sources[keep], targets[keep], weights[keep])
+
+    if added.edge_count() > 0:
+        for name in added.names:
+            if name not in ids:
+                ids[name] = len(names)
+                names.append(name)
+        table = np.array([ids[name] for name in added.names], dtype=np.int64)
+        sources = np.concatenate((sources, table[np.asarray(added.sources)]))
+        targets = np.concatenate((targets, table[np.asarray(added.targets)]))
+        weights = np.concatenate((weights, np.asarray(added.weights, dtype=np.float64)))
+
+    return EdgeList(names, sources.astype(np.int32), targets.astype(np.int32), weights)
+
+def encode_names(names: list) -> bytes:
+    """ Encode a name table the way the binary formats carry it """
+    table = b''.join(str(name).encode('utf-8')+b'\0' for name in names)
+    return table + b'\0'*(-len(table) % 8)
+
+def read_exactly(stream, size: int) -> bytearray:
+    """ Read size bytes into a new buffer """
+    data = bytearray(size)
+    view = memoryview(data)
+    pos = 0
+    while pos < size:
+        chunk = stream.read(min(size - pos, CHUNK_SIZE))
+        if not chunk:
+            raise ValueError('binary edge list is truncated')
+        view[pos:pos+len(chunk)] = chunk
+        pos += len(chunk)
+    return data
+
+def read_request_edges(req) -> EdgeList:
+    """ Read the edge list from a request, in whichever format it was sent.
+        It may be the request body itself, with our binary content type, or
+        the 'data' part of a multipart form, which is binary if that part has
+        our content type and JSON otherwise """
+    if (req.content_type or '').startswith(BINARY_TYPE):
+        return read_binary_edges(req.bounded_stream)
+    data = req.get_param('data')
+    if data is None:
+        raise ValueError('no data')
+    return read_part_edges(data)
+
+def iter_request_edge_lists(req):
+    """ Read every edge list in a request: the body, or each of the 'data'
+        parts of a multipart form, in order.  Each is read as it is asked for,
+        so the caller can time them """
+    if (req.content_type or '').startswith(BINARY_TYPE):
+        yield read_binary_edges(req.bounded_stream)
+        return
+    parts = req.params.get('data')
+    if parts is None:
+        raise ValueError('no data')
+    if not isinstance(parts, list):
+        parts = [parts]
+    for data in parts:
+        yield read_part_edges(data)
+
+def read_request_delta(req) -> tuple:
+    """ Read the (added, removed) edge lists of a warm start request.  A binary
+        edge list can only add edges """
+    if (req.content_type or '').startswith(BINARY_TYPE):
+        return (read_binary_edges(req.bounded_stream), EdgeList())
+    data = req.get_param('data')
+    if data is None:
+        return (EdgeList(), EdgeList())
+    if isinstance(data, (str, bytes)):
+        return read_json_delta(io.BytesIO(data.encode() if isinstance(data, str) else data))
+    if (data.type or '').startswith(BINARY_TYPE):
+        return (read_binary_edges(data.file), EdgeList())
+    return read_json_delta(data.file)
+
+def read_part_edges(data) -> EdgeList:
+    """ Read the edge list from one part of a multipart form """
+    if isinstance(data, (str, bytes)):
+        # A form field rather than a file
+        return read_json_edges(io.BytesIO(data.encode() if isinstance(data, str) else data))
+    if (data.type or '').startswith(BINARY_TYPE):
+        return read_binary_edges(data.file)
+    return read_json_edges(data.file)
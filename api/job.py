@@ -1,5 +1,54 @@
+import time
 import uuid
 
+# The states a job can be in.  These are stored as an index into this list
+STATES = ['queued', 'running', 'done', 'failed', 'timeout', 'oom']
+FINISHED = ('done', 'failed', 'timeout', 'oom')
+
+class StatusWord:
+    """ A worker's job status, held in one word of shared memory so that the
+        web process can read it without any IPC.  It looks enough like a dict
+        that the algorithms can keep doing status['status'] = 'running'.
+        Setting status['progress'] (a percentage) passes it to report, which
+        the worker points at its pipe.  Setting status['phase'] ends the
+        phase the job was in and starts a new one, and the time spent in each
+        phase is added up in timings """
+    def __init__(self, words, slot: int):
+        self.words = words
+        self.slot = slot
+        self.report = None
+        self.timings = {}
+        self.phase = None
+        self.phase_start = None
+
+    def __getitem__(self, key: str) -> str:
+        return STATES[self.words[self.slot]]
+
+    def __setitem__(self, key: str, value: str):
+        if key == 'progress':
+            if self.report is not None:
+                self.report(value)
+            return
+        if key == 'phase':
+            self.end_phase()
+            self.phase = value
+            self.phase_start = time.perf_counter()
+            return
+        self.words[self.slot] = STATES.index(value)
+
+    def reset_phases(self):
+        """ Forget the last job's timings """
+        self.timings = {}
+        self.phase = None
+
+    def end_phase(self) -> dict:
+        """ End the current phase, and return the timings so far """
+        if self.phase is not None:
+            elapsed = time.perf_counter() - self.phase_start
+            self.timings[self.phase] = self.timings.get(self.phase, 0) + elapsed
+            self.phase = None
+        return self.timings
+
 class Job:
     job_uuid = None
     algorithm = None
@@ -7,7 +56,37 @@ class Job:
     def __init__(self, job_uuid, algorithm):
         self.job_uuid = job_uuid
         self.algorithm = algorithm
+        self.state = 'queued'
+        self.worker = None
+        self.result = None
+        self.status_word = None
+        # The last progress the worker reported, as a percentage
+        self.progress = None
+        # The state we last wrote to the job store
+        self.recorded_state = 'queued'
+        # Where to put the result in the result cache
+        self.cache_key = None
+        # What we measured about the job: the size of its graph, the peak
+        # RSS of its worker and the seconds it spent in each phase
+        self.stats = {'timings': {}}
+        # When the job was queued on the pool, to time its wait
+        self.queued_at = None
+        # The edge list the pool shares with the worker, while the job is
+        # queued or running
+        self.shared_edges = None
 
-    def check_job(self):
-        # Check on the process status
-        pass
+    def get_status(self) -> str:
+        """ Get the status of the job.  While the job is on a worker we read the
+            worker's status word, otherwise our own state """
+        status_word = self.status_word
+        if status_word is not None:
+            state = status_word['status']
+            # The worker has finished, but we haven't heard about it yet
+            if state in FINISHED:
+                return 'running'
+            return state
+        if self.state in FINISHED:
+            # The pool has heard, but its listener hasn't stored the result
+            # yet.  Once it has, the job store answers for the job
+            return 'running'
+        return self.state
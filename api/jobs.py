@@ -1,21 +1,59 @@
 """ The Jobs module """
-from multiprocessing import Manager
+import json
 import os
+import threading
+import time
 import uuid
 import logging
 
 import falcon
 
+from . import config
+from .cache import ResultCache
+from .edgelist import EdgeList, read_shared_edges, write_shared_edges
+from .job import Job, FINISHED
+from .metrics import Metrics
+from .pool import WorkerPool, save_result
 from .service import Service
+from .store import JobStore, SQLiteJobStore, process_alive, process_id
 
 class Jobs:
-    """ A class to keep track of all running jobs """
+    """ A class to keep track of all running jobs.  The job records are kept in a
+        JobStore that is shared by every web process, so any of them can answer
+        for any job.  The unfinished jobs that this process queued are also in
+        active_jobs.  Finished jobs are reaped once their results have expired,
+        or when the results retained would otherwise exceed a total size """
     active_jobs = {}
-    manager = None
+    services = {}
+    pool = None
+    store = None
 
-    def __init__(self, manager:Manager):
+    def __init__(self, pool: WorkerPool = None, store: JobStore = None,
+                 cache: ResultCache = None, metrics: Metrics = None):
         self.active_jobs = {}
-        self.manager = manager
+        self.services = {}
+        self.owner = process_id()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.store = store if store is not None else SQLiteJobStore()
+        self.pool = pool if pool is not None else WorkerPool(listener=self.job_changed)
+        self.cache = cache if cache is not None else ResultCache(metrics=self.metrics)
+        self.housekeeper = None
+        # Results expire this many seconds after they were last fetched, or
+        # after the job finished if they are never fetched
+        self.fetched_ttl = config.get_float('FETCHED_TTL', 600)
+        self.result_ttl = config.get_float('RESULT_TTL', 24*3600)
+        self.max_result_bytes = config.get_int('MAX_RESULT_BYTES', 1 << 30)
+        self.reap_interval = config.get_float('REAP_INTERVAL', 30)
+        # Keep the graphs of jobs that ask for it, for later jobs to warm
+        # start from
+        self.keep_graphs = config.get_bool('KEEP_GRAPHS', True)
+        # Long polls and event streams wait on this.  The pool wakes them as
+        # soon as one of our jobs changes; jobs owned by other processes are
+        # checked in the store every poll_interval
+        self.changed = threading.Condition()
+        self.max_wait = config.get_float('MAX_WAIT', 60)
+        self.poll_interval = config.get_float('POLL_INTERVAL', 0.5)
+        self.keepalive = config.get_float('EVENTS_KEEPALIVE', 15)
         #logging.basicConfig(filename="/tmp/restLogger.log", level=logging.DEBUG)
 
     def create_job(self, url: str, service: Service) -> uuid.UUID:
@@ -24,59 +62,434 @@ class Jobs:
         # Create the uuid
         job_uuid = uuid.uuid4()
         # Add it to the list
-        self.active_jobs[job_uuid] = service
+        self.active_jobs[job_uuid] = Job(job_uuid, service.name)
+        self.store.create(job_uuid, service.name, self.owner)
         #logging.info('Created job %s for service %s [%d]'%(str(job_uuid), service, os.getpid()))
         return job_uuid
 
+    def create_finished_job(self, url: str, service: Service, result: bytes,
+                            edges: EdgeList = None, stats: dict = None) -> uuid.UUID:
+        """ Create a job that is already done, with the given encoded result.
+            This is how we answer from the result cache.  If edges are given
+            they are kept for later warm starts, and stats are recorded as the
+            job's stats """
+        job_uuid = uuid.uuid4()
+        self.store.create(job_uuid, service.name, self.owner)
+        if edges is not None:
+            self.save_edges(job_uuid, edges)
+        location = save_result(self.pool.result_dir, job_uuid, result)
+        self.store.update(job_uuid, state='done', result=location,
+                          size=len(result)+self.get_edges_size(job_uuid), finished=time.time())
+        if stats is not None:
+            self.store.record_stats(job_uuid, service.name, 'done', stats)
+        self.count_submitted(service.name, stats)
+        self.metrics.inc('restapi_jobs_finished_total', {'algorithm': service.name, 'state': 'done'})
+        return job_uuid
+
+    def get_edges_path(self, job_uuid: uuid.UUID) -> str:
+        """ Where we keep the graph a job ran on, if we keep it """
+        return os.path.join(self.pool.result_dir, str(job_uuid)+'.edges')
+
+    def save_edges(self, job_uuid: uuid.UUID, edges: EdgeList):
+        """ Keep the graph a job runs on, so that later jobs can start from it.
+            It lives and dies with the job's result.  The names keep their
+            types, so that the names in a later job's changes match them """
+        path = self.get_edges_path(job_uuid)
+        try:
+            os.remove(path+'.tmp')
+        except FileNotFoundError:
+            pass
+        write_shared_edges(edges, path+'.tmp')
+        os.replace(path+'.tmp', path)
+
+    def load_edges(self, job_uuid: uuid.UUID) -> EdgeList:
+        """ The graph a job ran on, or None if we didn't keep it """
+        try:
+            return read_shared_edges(self.get_edges_path(job_uuid))
+        except FileNotFoundError:
+            return None
+
+    def get_edges_size(self, job_uuid: uuid.UUID) -> int:
+        try:
+            return os.path.getsize(self.get_edges_path(job_uuid))
+        except FileNotFoundError:
+            return 0
+
+    def add_service(self, name: str, service: Service):
+        """ Register a service whose jobs run on our worker pool """
+        service.name = name
+        self.services[name] = service
+        self.pool.add_service(name, service)
+
+    def get_service(self, job_uuid: uuid.UUID) -> Service:
+        """ Find the service that runs a job """
+        record = self.store.get(job_uuid)
+        if record is None:
+            return None
+        return self.services.get(record['algorithm'])
+
+    def start(self):
+        """ Start the worker pool once all of the services are registered """
+        self.pool.start()
+        self.housekeeper = threading.Thread(target=self.housekeeping, name='jobs-housekeeper',
+                                            daemon=True)
+        self.housekeeper.start()
+
+    def submit(self, job_uuid: uuid.UUID, args: dict, cache_key: str = None,
+               stats: dict = None):
+        """ Queue a job on the worker pool.  Raises QueueFull if we are at capacity.
+            If cache_key is given, the result is cached under it.  stats are
+            what the web process measured about the job before queueing it """
+        job = self.active_jobs[job_uuid]
+        job.cache_key = cache_key
+        if stats is not None:
+            job.stats = stats
+        self.pool.submit(job, args)
+        self.count_submitted(job.algorithm, stats)
+
+    def count_submitted(self, algorithm: str, stats: dict):
+        """ Count a job that was accepted, and the size of its graph """
+        labels = {'algorithm': algorithm}
+        self.metrics.inc('restapi_jobs_submitted_total', labels)
+        for name in ('nodes', 'edges'):
+            if stats is not None and name in stats:
+                self.metrics.observe('restapi_graph_'+name, stats[name], labels)
+
+    def count_finished(self, job: Job):
+        """ Count a job that finished, and how long it spent in each phase """
+        labels = {'algorithm': job.algorithm}
+        self.metrics.inc('restapi_jobs_finished_total', dict(labels, state=job.state))
+        for (phase, seconds) in job.stats.get('timings', {}).items():
+            self.metrics.observe('restapi_job_phase_seconds', seconds, dict(labels, phase=phase))
+        if 'peak_rss_bytes' in job.stats:
+            self.metrics.observe('restapi_job_peak_rss_bytes', job.stats['peak_rss_bytes'], labels)
+
+    def job_changed(self, job: Job):
+        """ Called by the pool when one of our jobs changes state or reports
+            progress """
+        if job.state not in FINISHED:
+            if job.state != job.recorded_state:
+                self.store.update(job.job_uuid, state=job.state, worker=job.worker)
+                job.recorded_state = job.state
+        else:
+            # The store answers for the job from now on, and a job is only
+            # recorded as finished once
+            if self.active_jobs.pop(job.job_uuid, None) is None:
+                self.remove_orphan(job)
+                return
+            size = os.path.getsize(job.result) if job.result is not None else 0
+            size += self.get_edges_size(job.job_uuid)
+            self.store.update(job.job_uuid, state=job.state, worker=job.worker,
+                              result=job.result, size=size, finished=time.time())
+            self.store.record_stats(job.job_uuid, job.algorithm, job.state, job.stats)
+            self.count_finished(job)
+            if job.state == 'done' and job.cache_key is not None:
+                self.cache.put(job.cache_key, job.result)
+        self.notify_changed()
+
+    def remove_orphan(self, job: Job):
+        """ Remove the result of a job that was terminated while its worker
+            was finishing it.  Nothing points at the result, so it would never
+            be reaped """
+        if job.result is None:
+            return
+        record = self.store.get(job.job_uuid)
+        if record is not None and record['result'] == job.result:
+            return
+        try:
+            os.remove(job.result)
+        except FileNotFoundError:
+            pass
+
+    def notify_changed(self):
+        """ Wake everyone waiting for a job to change """
+        with self.changed:
+            self.changed.notify_all()
+
     def remove_job(self, job_uuid: uuid.UUID):
         """ Remove the job from our list"""
         #logging.info('Removing job %s'%str(job_uuid))
-        del self.active_jobs[job_uuid]
+        self.active_jobs.pop(job_uuid, None)
+        record = self.store.get(job_uuid)
+        if record is None:
+            return
+        for path in (record['result'], self.get_edges_path(job_uuid)):
+            if path is None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.store.remove(job_uuid)
+        self.notify_changed()
 
     def check_job(self, job_uuid: uuid.UUID) -> str:
         """ Check the status of a running job """
-        if job_uuid in self.active_jobs:
-            return self.active_jobs[job_uuid].get_status()
-        return None
+        job = self.active_jobs.get(job_uuid)
+        if job is not None:
+            return job.get_status()
+        record = self.store.get(job_uuid)
+        if record is None:
+            return None
+        return record['state']
+
+    def wait_for_change(self, job_uuid: uuid.UUID, state: str, timeout: float) -> str:
+        """ Wait up to timeout seconds for a job to leave state, and return the
+            state it is in then """
+        deadline = time.time() + min(timeout, self.max_wait)
+        with self.changed:
+            while True:
+                current = self.check_job(job_uuid)
+                remaining = deadline - time.time()
+                if current != state or current in FINISHED or remaining <= 0:
+                    return current
+                self.changed.wait(min(remaining, self.poll_interval))
+
+    def get_stats(self, job_uuid: uuid.UUID) -> dict:
+        """ What we measured about a job: its graph size, the peak RSS of its
+            worker and the seconds it spent in each phase.  Jobs still running
+            only have the phases they have finished """
+        job = self.active_jobs.get(job_uuid)
+        if job is not None:
+            return job.stats
+        return self.store.get_stats(job_uuid)
 
-    def on_get(self, req: falcon.Request, resp: falcon.Response, job_id: str):
-        """ Handles GET requests /status and /fetch """
+    def get_recent_stats(self, algorithm: str = None, limit: int = 100) -> dict:
+        """ The stats of the most recent jobs, newest first, and for each
+            algorithm the mean of each timing and the largest peak RSS and graph.
+            Jobs answered from the result cache are only counted """
+        jobs = self.store.recent_stats(algorithm, limit)
+        summary = {}
+        for record in jobs:
+            stats = record['stats']
+            entry = summary.setdefault(record['algorithm'], {'jobs': 0, 'cached': 0, 'timings': {}})
+            if stats.get('cached'):
+                entry['cached'] += 1
+                continue
+            entry['jobs'] += 1
+            for (phase, seconds) in stats.get('timings', {}).items():
+                entry['timings'][phase] = entry['timings'].get(phase, 0) + seconds
+            for name in ('peak_rss_bytes', 'nodes', 'edges'):
+                if name in stats:
+                    entry['max_'+name] = max(entry.get('max_'+name, 0), stats[name])
+        for entry in summary.values():
+            # Not every job gets through every phase, but the mean is over all
+            # of them, so that the phases add up
+            entry['timings'] = {phase: seconds/max(entry['jobs'], 1)
+                                for (phase, seconds) in entry['timings'].items()}
+        return {'jobs': jobs, 'summary': summary}
+
+    def get_event(self, job_uuid: uuid.UUID) -> dict:
+        """ The state of a job, and its progress if it is one of ours """
+        event = {'status': self.check_job(job_uuid)}
+        job = self.active_jobs.get(job_uuid)
+        if job is not None and job.progress is not None:
+            event['progress'] = job.progress
+        return event
+
+    def job_events(self, job_uuid: uuid.UUID):
+        """ Generate server-sent events for each change in a job's state or
+            progress, until it finishes (or disappears), with a comment every
+            keepalive seconds to hold the connection open """
+        last = None
+        sent = time.time()
+        while True:
+            with self.changed:
+                event = self.get_event(job_uuid)
+                if event == last:
+                    self.changed.wait(self.poll_interval)
+                    event = self.get_event(job_uuid)
+            if event != last:
+                last = event
+                sent = time.time()
+                yield ('event: status\ndata: '+json.dumps(event)+'\n\n').encode()
+                if event['status'] is None or event['status'] in FINISHED:
+                    return
+            elif time.time() - sent >= self.keepalive:
+                sent = time.time()
+                yield b': keepalive\n\n'
+
+    def get_result(self, job_uuid: uuid.UUID) -> tuple:
+        """ Get the status of a job and, if it has finished, its encoded result """
+        (state, f) = self.open_result(job_uuid)
+        if f is None:
+            return (state, None)
+        with f:
+            return (state, f.read())
+
+    def open_result(self, job_uuid: uuid.UUID) -> tuple:
+        """ Get the status of a job and, if it has finished, its encoded
+            result as a file open for reading, so that a large result can be
+            streamed.  The file stays readable even if the job is reaped """
+        state = self.check_job(job_uuid)
+        if state not in FINISHED:
+            return (state, None)
+        record = self.store.get(job_uuid)
+        if record is None or record['result'] is None:
+            return (state, None)
+        try:
+            f = open(record['result'], 'rb')
+        except FileNotFoundError:
+            # It was reaped under us
+            return (None, None)
+        self.store.update(job_uuid, fetched=time.time())
+        return (state, f)
+
+    def terminate(self, job_uuid: uuid.UUID) -> bool:
+        """ Terminate a job.  If another process is still running it, we ask
+            that process to do it for us """
+        record = self.store.get(job_uuid)
+        if record is None:
+            return False
+        if record['owner'] == self.owner or record['state'] in FINISHED:
+            self.pool.cancel(job_uuid)
+            self.remove_job(job_uuid)
+        else:
+            self.store.update(job_uuid, cancel=1)
+        return True
+
+    def housekeeping(self):
+        """ Carry out the terminate requests that other processes have made
+            for our jobs, and reap old jobs every reap_interval """
+        last_reap = 0
+        while True:
+            try:
+                self.update_gauges()
+                for job_uuid in self.store.cancelled(self.owner):
+                    self.pool.cancel(job_uuid)
+                    self.remove_job(job_uuid)
+                if time.time() - last_reap >= self.reap_interval:
+                    self.reap()
+                    self.metrics.fold()
+                    last_reap = time.time()
+            except Exception:
+                logging.exception('housekeeping failed')
+            time.sleep(1)
+
+    def reap(self):
+        """ Join dead workers, fail the jobs of web processes that have died,
+            and remove expired results (and the batches left empty), then the
+            least recently used results until we are under max_result_bytes """
+        now = time.time()
+        self.pool.check_workers()
+        for (job_uuid, owner) in self.store.unfinished():
+            if not process_alive(owner):
+                #logging.info('Failing orphaned job %s of %s'%(str(job_uuid), owner))
+                self.store.update(job_uuid, state='failed', finished=now)
+        for job_uuid in self.store.expired(now - self.fetched_ttl, now - self.result_ttl):
+            self.remove_job(job_uuid)
+        self.store.remove_empty_batches()
+        excess = self.store.counts()['retained_bytes'] - self.max_result_bytes
+        if excess <= 0:
+            return
+        for (job_uuid, size) in self.store.least_recently_used():
+            if excess <= 0:
+                break
+            self.remove_job(job_uuid)
+            excess -= size
+
+    def get_counts(self) -> dict:
+        """ Count the live (running), queued and retained (finished) jobs """
+        counts = self.store.counts()
+        return {'live': counts.get('running', 0),
+                'queued': counts.get('queued', 0),
+                'retained': sum(counts.get(state, 0) for state in FINISHED),
+                'retained_bytes': counts['retained_bytes'],
+                'workers': self.pool.size,
+                'busy_workers': self.pool.busy(),
+                'local_queued': self.pool.queued(),
+                'cache': self.cache.get_stats()}
+
+    def update_gauges(self):
+        """ Publish this process's queue depth and worker usage """
+        self.metrics.set('restapi_queue_depth', self.pool.queued())
+        self.metrics.set('restapi_workers', self.pool.size)
+        self.metrics.set('restapi_workers_busy', self.pool.busy())
+
+    def get_metrics(self) -> str:
+        """ The metrics of every web process, plus the jobs in the store by
+            algorithm and state, in the Prometheus text format """
+        self.update_gauges()
+        samples = [('restapi_jobs', {'algorithm': algorithm, 'state': state}, count)
+                   for ((algorithm, state), count) in self.store.algorithm_counts().items()]
+        return self.metrics.render(samples)
+
+    def on_get(self, req: falcon.Request, resp: falcon.Response, job_id: str = None):
+        """ Handles GET requests /status, /events, /fetch, /terminate, /jobs, /stats
+            and /metrics """
         path = req.path
         #print('path: '+path)
         #print('job_id: '+job_id)
         #logging.info('path: %s, job_id: %s [%d]'%(path,job_id,os.getpid()))
         if path.startswith("/status/"):
             uid = get_job_id(job_id)
-            if uid in self.active_jobs:
+            service = self.get_service(uid)
+            if service is not None:
+                status = service.get_status(uid)
+                # Long poll: hold on to the request until the state changes
+                wait = req.get_param_as_float('wait')
+                if wait is not None and wait > 0:
+                    status = self.wait_for_change(uid, status, wait)
                 resp.code = falcon.HTTP_200
-                resp.body = str(self.active_jobs[uid].get_status(uid))
+                if req.get_param('format') == 'json':
+                    event = self.get_event(uid)
+                    event['status'] = status
+                    event['stats'] = self.get_stats(uid)
+                    resp.body = json.dumps(event)
+                else:
+                    resp.body = str(status)
+                return
+            add_error(resp, "No such job")
+            return
+
+        if path.startswith("/events/"):
+            uid = get_job_id(job_id)
+            service = self.get_service(uid)
+            if service is not None:
+                resp.status = falcon.HTTP_200
+                resp.content_type = 'text/event-stream'
+                resp.set_header('Cache-Control', 'no-cache')
+                resp.stream = self.job_events(uid)
                 return
             add_error(resp, "No such job")
             return
 
         if path.startswith("/fetch/"):
             uid = get_job_id(job_id)
-            if uid in self.active_jobs:
-                self.active_jobs[uid].fetch_results(uid, req, resp)
+            service = self.get_service(uid)
+            if service is not None:
+                service.fetch_results(uid, req, resp)
                 return
             add_error(resp, "No such job")
             return
 
         if path.startswith("/terminate/"):
             uid = get_job_id(job_id)
-            if uid in self.active_jobs:
-                self.active_jobs[uid].terminate(uid, req, resp)
+            service = self.get_service(uid)
+            if service is not None:
+                service.terminate(uid, req, resp)
                 return
             add_error(resp, "No such job")
             return
 
         if path.startswith("/jobs"):
+            resp.status = falcon.HTTP_200
+            resp.body = json.dumps(self.get_counts())
             return
 
-        #print('no matching path')
+        if path.startswith("/stats"):
+            limit = req.get_param_as_int('limit') or 100
+            resp.status = falcon.HTTP_200
+            resp.body = json.dumps(self.get_recent_stats(req.get_param('algorithm'), limit))
+            return
 
-    def get_manager(self):
-        return self.manager
+        if path.startswith("/metrics"):
+            resp.status = falcon.HTTP_200
+            resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            resp.body = self.get_metrics()
+            return
+
+        #print('no matching path')
 
 def get_job_id(job_id: str) -> uuid.UUID:
     """ Get the job id from a URL """
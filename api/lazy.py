@@ -0,0 +1,23 @@
+"""
+Lazily imported modules.  igraph, pandas and scanpy take seconds and
+hundreds of MB to import, and the web process only needs them for some of
+its routes, so they are imported the first time they are used
+"""
+
+import importlib
+
+class LazyModule:
+    """ Stands in for a module until one of its attributes is needed, and
+        then imports it.  importlib serializes concurrent imports, so the
+        first use can come from any thread """
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return '<lazy module '+repr(self._name)+'>'
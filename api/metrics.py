@@ -0,0 +1,329 @@
+"""
+Metrics in the Prometheus text format.  Each web process counts into a
+memory mapped file of its own in a directory they all share, so counting is a
+dict lookup and a store into memory, and whichever process answers /metrics
+adds up the files of all of them.  The counts of processes that have exited
+are folded into one totals file, so the directory doesn't grow without bound
+"""
+
+import fcntl
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+import falcon
+
+from . import config
+from .store import pid_alive
+
+# Each file is an 8 byte header holding the number of bytes used, then the
+# entries: a uint32 key length, the UTF-8 key padded to 8 bytes, and the
+# float64 value
+HEADER = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+INITIAL_SIZE = 1 << 16
+# The counts of the processes that have exited, and the names of their
+# counter files, which are removed once they are in the totals
+TOTALS = 'totals.json'
+
+# The histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (10, 100, 1000, 1e4, 1e5, 1e6, 1e7, 1e8)
+PHASE_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800, 3600)
+MEMORY_BUCKETS = tuple(float(1 << shift) for shift in range(24, 38, 2))
+
+# The type, help and, for histograms, buckets of every metric
+METRICS = {
+    'restapi_http_request_duration_seconds':
+        ('histogram', 'Time to answer a request, by route, method and status', LATENCY_BUCKETS),
+    'restapi_jobs_submitted_total':
+        ('counter', 'Jobs submitted, by algorithm, including those answered from the cache', None),
+    'restapi_jobs_finished_total':
+        ('counter', 'Jobs finished, by algorithm and state', None),
+    'restapi_jobs':
+        ('gauge', 'Jobs in the job store, by algorithm and state', None),
+    'restapi_job_phase_seconds':
+        ('histogram', 'Time finished jobs spent in each phase, by algorithm', PHASE_BUCKETS),
+    'restapi_job_peak_rss_bytes':
+        ('histogram', 'Peak resident set size of the worker during a job, by algorithm',
+         MEMORY_BUCKETS),
+    'restapi_graph_nodes':
+        ('histogram', 'Nodes in the graph of each job, by algorithm', SIZE_BUCKETS),
+    'restapi_graph_edges':
+        ('histogram', 'Edges in the graph of each job, by algorithm', SIZE_BUCKETS),
+    'restapi_cache_hits_total':
+        ('counter', 'Requests answered from the result cache, by tier', None),
+    'restapi_cache_misses_total':
+        ('counter', 'Cacheable requests that were not in the result cache', None),
+    'restapi_queue_depth':
+        ('gauge', 'Jobs waiting for a worker, by web process', None),
+    'restapi_workers':
+        ('gauge', 'Worker processes, by web process', None),
+    'restapi_workers_busy':
+        ('gauge', 'Worker processes running a job, by web process', None),
+}
+
+class ValueFile:
+    """ float64 values by key, in a memory mapped file that only this
+        process writes """
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = {}
+        self.lock = threading.Lock()
+        self.f = open(path, 'w+b')
+        self.f.truncate(INITIAL_SIZE)
+        self.map = mmap.mmap(self.f.fileno(), INITIAL_SIZE)
+        self.used = HEADER.size
+        HEADER.pack_into(self.map, 0, self.used)
+
+    def add(self, key: str, amount: float):
+        with self.lock:
+            offset = self._offset(key)
+            VALUE.pack_into(self.map, offset, VALUE.unpack_from(self.map, offset)[0] + amount)
+
+    def set(self, key: str, value: float):
+        with self.lock:
+            VALUE.pack_into(self.map, self._offset(key), value)
+
+    def _offset(self, key: str) -> int:
+        """ Where the value of key is, adding it if it is new.  Called with
+            the lock held """
+        offset = self.offsets.get(key)
+        if offset is not None:
+            return offset
+        encoded = key.encode()
+        padded = align(KEY_LENGTH.size + len(encoded))
+        size = padded + VALUE.size
+        if self.used + size > len(self.map):
+            self._grow(self.used + size)
+        KEY_LENGTH.pack_into(self.map, self.used, len(encoded))
+        self.map[self.used+KEY_LENGTH.size:self.used+KEY_LENGTH.size+len(encoded)] = encoded
+        offset = self.used + padded
+        VALUE.pack_into(self.map, offset, 0.0)
+        # Readers only look as far as the header says, so the entry must be
+        # complete before we count it
+        self.used += size
+        HEADER.pack_into(self.map, 0, self.used)
+        self.offsets[key] = offset
+        return offset
+
+    def _grow(self, needed: int):
+        size = len(self.map)
+        while size < needed:
+            size *= 2
+        self.map.close()
+        self.f.truncate(size)
+        self.map = mmap.mmap(self.f.fileno(), size)
+
+def align(size: int) -> int:
+    """ Round up to a multiple of 8 """
+    return (size + 7) & ~7
+
+def read_values(path: str) -> dict:
+    """ All of the values in a ValueFile, by key """
+    with open(path, 'rb') as f:
+        data = f.read()
+    values = {}
+    if len(data) < HEADER.size:
+        return values
+    used = min(HEADER.unpack_from(data, 0)[0], len(data))
+    offset = HEADER.size
+    while offset < used:
+        length = KEY_LENGTH.unpack_from(data, offset)[0]
+        key = data[offset+KEY_LENGTH.size:offset+KEY_LENGTH.size+length].decode()
+        offset += align(KEY_LENGTH.size + length)
+        values[key] = VALUE.unpack_from(data, offset)[0]
+        offset += VALUE.size
+    return values
+
+def get_key(name: str, labels: dict) -> str:
+    return json.dumps([name, labels or {}], sort_keys=True)
+
+class Metrics:
+    """ The metrics of this process.  Counters and histograms add up over
+        every process that has ever counted in the directory, while gauges
+        are only kept while the process that set them is alive """
+    def __init__(self, directory: str = None):
+        self.directory = directory or config.get_string('METRICS_DIR', '/tmp/restapi/metrics')
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.counters = None
+        self.gauges = None
+
+    def get_files(self) -> tuple:
+        """ This process's counter and gauge files.  They are opened on first
+            use, so that a process forked from us gets files of its own, and
+            named by our pid and start time, so that a later process with the
+            same pid doesn't overwrite our counts """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                name = '%d_%d.db' % (self.pid, time.time()*1000)
+                self.counters = ValueFile(os.path.join(self.directory, 'counters_'+name))
+                self.gauges = ValueFile(os.path.join(self.directory, 'gauges_'+name))
+            return (self.counters, self.gauges)
+
+    def inc(self, name: str, labels: dict = None, amount: float = 1):
+        """ Add to a counter """
+        self.get_files()[0].add(get_key(name, labels), amount)
+
+    def set(self, name: str, value: float, labels: dict = None):
+        """ Set a gauge """
+        self.get_files()[1].set(get_key(name, labels), value)
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        """ Add a value to a histogram """
+        labels = labels or {}
+        bound = next((b for b in METRICS[name][2] if value <= b), None)
+        counters = self.get_files()[0]
+        counters.add(get_key(name+'_bucket', dict(labels, le=format_value(bound)
+                                                  if bound is not None else '+Inf')), 1)
+        counters.add(get_key(name+'_count', labels), 1)
+        counters.add(get_key(name+'_sum', labels), value)
+
+    def locked(self, operation: int):
+        """ Lock the directory against folding, shared to read the counts
+            and exclusive to fold them.  The lock is released when the file
+            returned is closed """
+        f = open(os.path.join(self.directory, 'lock'), 'a')
+        fcntl.flock(f, operation)
+        return f
+
+    def read_totals(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, TOTALS)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'values': {}, 'folded': []}
+
+    def fold(self):
+        """ Add the counter files of the processes that have exited into the
+            totals, and remove them.  The totals name the files they have
+            taken in, so that a file is never counted twice even if we stop
+            between writing the totals and removing it """
+        with self.locked(fcntl.LOCK_EX):
+            totals = self.read_totals()
+            folded = set(totals['folded'])
+            paths = [path for path in glob.glob(os.path.join(self.directory, 'counters_*.db'))
+                     if not pid_alive(int(os.path.basename(path).split('_')[1]))]
+            for path in paths:
+                if os.path.basename(path) in folded:
+                    continue
+                for (key, value) in read_values(path).items():
+                    totals['values'][key] = totals['values'].get(key, 0) + value
+            if not paths and not totals['folded']:
+                return
+            totals['folded'] = [os.path.basename(path) for path in paths]
+            with open(os.path.join(self.directory, TOTALS+'.tmp'), 'w') as f:
+                json.dump(totals, f)
+            os.replace(os.path.join(self.directory, TOTALS+'.tmp'),
+                       os.path.join(self.directory, TOTALS))
+            for path in paths:
+                os.remove(path)
+
+    def collect(self) -> dict:
+        """ Add up the totals and the files of every process: the counters
+            of all of them, and the gauges of those still running.  The gauge
+            files of processes that have exited are removed """
+        self.get_files()
+        with self.locked(fcntl.LOCK_SH):
+            totals = self.read_totals()
+            samples = totals['values']
+            folded = set(totals['folded'])
+            for path in glob.glob(os.path.join(self.directory, 'counters_*.db')):
+                if os.path.basename(path) in folded:
+                    continue
+                for (key, value) in read_values(path).items():
+                    samples[key] = samples.get(key, 0) + value
+        for path in glob.glob(os.path.join(self.directory, 'gauges_*.db')):
+            pid = int(os.path.basename(path).split('_')[1])
+            if not pid_alive(pid):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            for (key, value) in read_values(path).items():
+                (name, labels) = json.loads(key)
+                labels['pid'] = str(pid)
+                samples[get_key(name, labels)] = value
+        return samples
+
+    def render(self, samples: list = ()) -> str:
+        """ Everything we have collected, plus the (name, labels, value)
+            samples given, in the Prometheus text format """
+        collected = {}
+        for (key, value) in self.collect().items():
+            (name, labels) = json.loads(key)
+            collected.setdefault(name, []).append((labels, value))
+        for (name, labels, value) in samples:
+            collected.setdefault(name, []).append((labels, value))
+        lines = []
+        for (name, (kind, description, buckets)) in METRICS.items():
+            lines.append('# HELP '+name+' '+description)
+            lines.append('# TYPE '+name+' '+kind)
+            if kind != 'histogram':
+                for (labels, value) in sorted(collected.get(name, []), key=sort_key):
+                    lines.append(format_sample(name, labels, value))
+                continue
+            # The buckets are counted apart, and made cumulative here
+            counts = {}
+            for (labels, value) in collected.get(name+'_bucket', []):
+                le = labels.pop('le')
+                counts.setdefault(json.dumps(labels, sort_keys=True), {})[le] = value
+            sums = dict((json.dumps(labels, sort_keys=True), value)
+                        for (labels, value) in collected.get(name+'_sum', []))
+            for (key, count) in sorted((json.dumps(labels, sort_keys=True), value)
+                                       for (labels, value) in collected.get(name+'_count', [])):
+                labels = json.loads(key)
+                by_bound = counts.get(key, {})
+                total = 0
+                for bound in buckets:
+                    total += by_bound.get(format_value(bound), 0)
+                    lines.append(format_sample(name+'_bucket',
+                                               dict(labels, le=format_value(bound)), total))
+                lines.append(format_sample(name+'_bucket', dict(labels, le='+Inf'), count))
+                lines.append(format_sample(name+'_sum', labels, sums.get(key, 0)))
+                lines.append(format_sample(name+'_count', labels, count))
+        return '\n'.join(lines)+'\n'
+
+def sort_key(sample: tuple) -> str:
+    return json.dumps(sample[0], sort_keys=True)
+
+def format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+def format_sample(name: str, labels: dict, value: float) -> str:
+    if labels:
+        name += '{'+','.join(key+'="'+escape(str(labels[key]))+'"'
+                             for key in sorted(labels))+'}'
+    return name+' '+format_value(value)
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+class MetricsMiddleware:
+    """ Times every request, by the route it matched """
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    def process_request(self, req: falcon.Request, resp: falcon.Response):
+        req.context.start = time.perf_counter()
+
+    def process_response(self, req: falcon.Request, resp: falcon.Response, resource,
+                         req_succeeded: bool):
+        start = getattr(req.context, 'start', None)
+        if start is None:
+            return
+        self.metrics.observe('restapi_http_request_duration_seconds',
+                             time.perf_counter() - start,
+                             {'route': req.uri_template or 'unmatched', 'method': req.method,
+                              'status': str(resp.status).split(' ', 1)[0]})
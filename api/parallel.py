@@ -0,0 +1,66 @@
+"""
+Running the parts of one job in parallel.  The worker forks helpers of its
+own once the job has built what the parts share, such as its graph, so the
+helpers inherit it rather than being sent a copy
+"""
+
+import multiprocessing
+import os
+import sys
+
+from . import config
+from .job import STATES
+
+# The function and items of the map we are running, for the helpers to
+# inherit, since a closure can't be sent to them
+_task = None
+# The status words of the pool's workers, when we are one of them
+_status_words = None
+
+def set_status_words(words):
+    """ Tell a worker where to see which of the pool's workers are running
+        jobs """
+    global _status_words
+    _status_words = words
+
+def get_processes() -> int:
+    """ The number of processes one job may use: JOB_PROCESSES, or by
+        default an even share of the cores between the workers running jobs
+        as it starts, so that a job on an otherwise idle pool can use all of
+        them """
+    processes = config.get_int('JOB_PROCESSES', 0)
+    if processes > 0:
+        return processes
+    running = 1
+    if _status_words is not None:
+        running = max(1, sum(1 for word in _status_words if STATES[word] == 'running'))
+    return max(1, (os.cpu_count() or 1) // running)
+
+def parallel_map(function, items: list, processes: int = None) -> list:
+    """ [function(item) for item in items], spread over up to processes
+        forked helpers.  function may use anything the caller has built, but
+        what it returns is sent back, so it should be compact, e.g. a
+        membership array rather than a VertexClustering """
+    global _task
+    items = list(items)
+    processes = min(processes or get_processes(), len(items))
+    if processes <= 1:
+        return [function(item) for item in items]
+    _task = (function, items)
+    try:
+        # Leaving the with terminates the helpers, even if the job is stopped
+        with multiprocessing.get_context('fork').Pool(processes, initializer=_start) as pool:
+            return pool.map(_run, range(len(items)), chunksize=1)
+    finally:
+        _task = None
+
+def _start():
+    """ The worker's progress handler writes to its pipe, which only the
+        worker may do """
+    igraph = sys.modules.get('igraph')
+    if igraph is not None:
+        igraph.set_progress_handler(None)
+
+def _run(index: int):
+    (function, items) = _task
+    return function(items[index])
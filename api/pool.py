@@ -0,0 +1,650 @@
+"""
+A pool of long-lived worker processes that run the clustering jobs
+"""
+
+import atexit
+import collections
+import importlib
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+import json
+import os
+import resource
+import signal
+import stat
+import sys
+import threading
+import time
+from uuid import UUID
+
+from . import config
+from .edgelist import EdgeList, read_shared_edges, write_shared_edges
+from .job import Job, StatusWord
+from .parallel import set_status_words
+from .store import pid_alive, process_id
+
+class QueueFull(Exception):
+    """ Raised when the pool won't accept any more jobs """
+    def __init__(self, retry_after: int):
+        super().__init__("job queue is full")
+        self.retry_after = retry_after
+
+class JobStopped(Exception):
+    """ Raised in a worker when the pool asks it to stop its job """
+
+class Worker:
+    """ The parent's view of one worker process """
+    def __init__(self, slot: int, process, conn):
+        self.slot = slot
+        self.process = process
+        self.conn = conn
+        self.job = None
+        # When the job must be done by, and once we have asked the worker to
+        # stop it, when it must have stopped and the state the job ends in
+        self.deadline = None
+        self.stop_deadline = None
+        self.stop_state = None
+
+class SharedEdges:
+    """ An edge list that the pool has written for its workers to map, and
+        the number of jobs using it """
+    def __init__(self, edges: EdgeList, path: str):
+        # Holding on to the edge list keeps its id from being reused
+        self.edges = edges
+        self.path = path
+        self.jobs = 0
+
+class WorkerPool:
+    """ A fixed set of warm worker processes fed from a bounded queue.  Pending
+        jobs are kept per algorithm and dispatched round-robin, and each algorithm
+        may only occupy a limited number of workers, so a backlog of slow jobs for
+        one algorithm can't starve the others.  Each algorithm may also have a
+        time limit and a memory limit for its jobs. """
+
+    def __init__(self, size: int = None, max_queued: int = None, result_dir: str = None,
+                 listener = None, preload: list = None):
+        self.size = size or config.get_int('POOL_WORKERS', os.cpu_count() or 1)
+        self.max_queued = max_queued or config.get_int('POOL_QUEUE', 8*self.size)
+        self.default_limit = config.get_int('ALGORITHM_LIMIT', max(1, self.size-1))
+        self.retry_after = config.get_int('RETRY_AFTER', 5)
+        # No limit unless these are set
+        self.default_timeout = config.get_float('TIMEOUT', 0)
+        self.default_max_memory = config.get_int('MAX_MEMORY', 0)
+        # How long a worker has to stop a job before we kill it
+        self.stop_grace = config.get_float('STOP_GRACE', 2)
+        self.result_dir = result_dir or config.get_string('RESULT_DIR', '/tmp/restapi/results')
+        make_private_directory(self.result_dir)
+        # The modules each worker imports as it starts, rather than during
+        # its first job
+        if preload is None:
+            preload = [name.strip() for name in config.get_string('POOL_PRELOAD', 'igraph').split(',')
+                       if name.strip()]
+        self.preload = preload
+        # Graphs are handed to the workers in files that they map, by default
+        # in shared memory, rather than being sent down their pipes.  The jobs
+        # of a batch that use the same graph share one file.  An empty
+        # GRAPH_DIR turns this off
+        self.graph_dir = config.get_string('GRAPH_DIR', '/dev/shm/restapi'
+                                           if os.path.isdir('/dev/shm') else '/tmp/restapi/graphs')
+        self.shared_edges = {}
+        self.shared_count = 0
+        # The files are named by our pid and start time, and a count
+        self.started = int(time.time()*1000)
+        # Called with each job whose state changes.  The changes are queued
+        # while we hold the lock and delivered, in order, once we don't
+        self.listener = listener
+        self.events = collections.deque()
+        self.delivering = threading.Lock()
+        self.context = multiprocessing.get_context('fork')
+        # One status word per worker slot
+        self.status_words = self.context.RawArray('b', self.size)
+        self.services = {}
+        self.limits = {}
+        self.timeouts = {}
+        self.memory_limits = {}
+        self.pending = collections.OrderedDict()
+        self.running = collections.Counter()
+        self.workers = []
+        self.lock = threading.RLock()
+        self.collector = None
+        self.stopping = False
+
+    def add_service(self, name: str, service):
+        """ Register a service so the workers can run its jobs """
+        self.services[name] = service
+        self.limits[name] = config.get_int('LIMIT_'+name.upper(), self.default_limit)
+        self.timeouts[name] = config.get_float('TIMEOUT_'+name.upper(), self.default_timeout)
+        self.memory_limits[name] = config.get_int('MAX_MEMORY_'+name.upper(),
+                                                  self.default_max_memory)
+
+    def start(self):
+        """ Fork the workers.  This must be called after all of the services
+            have been added, since the workers inherit them """
+        with self.lock:
+            if self.collector is not None:
+                return
+            if self.graph_dir:
+                try:
+                    make_private_directory(self.graph_dir)
+                    remove_stale_graphs(self.graph_dir)
+                except PermissionError as e:
+                    logging.warning('sending graphs down the pipes: %s', e)
+                    self.graph_dir = None
+            for slot in range(self.size):
+                self.workers.append(self._spawn(slot))
+            self.collector = threading.Thread(target=self._collect, name='pool-collector',
+                                              daemon=True)
+            self.collector.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        """ Stop all of the workers """
+        with self.lock:
+            self.stopping = True
+            workers = list(self.workers)
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+        with self.lock:
+            for shared in self.shared_edges.values():
+                remove_graph(shared.path)
+            self.shared_edges.clear()
+
+    def is_full(self) -> bool:
+        return self.queued() >= self.max_queued
+
+    def busy(self) -> int:
+        """ The number of workers running a job """
+        with self.lock:
+            return sum(1 for worker in self.workers if worker.job is not None)
+
+    def queued(self) -> int:
+        """ The number of jobs waiting for a worker """
+        with self.lock:
+            return sum(len(jobs) for jobs in self.pending.values())
+
+    def submit(self, job: Job, args: dict):
+        """ Queue a job.  Raises QueueFull if the queue is at capacity """
+        if self.is_full():
+            raise QueueFull(self.retry_after)
+        args = self._share_edges(job, args)
+        with self.lock:
+            if self.is_full():
+                self._release_edges(job)
+                raise QueueFull(self.retry_after)
+            if job.algorithm not in self.pending:
+                self.pending[job.algorithm] = collections.deque()
+            job.queued_at = time.time()
+            self.pending[job.algorithm].append((job, args))
+            self._dispatch()
+
+    def cancel(self, uid: UUID) -> bool:
+        """ Drop a queued job, or stop the worker running it.  Returns False if
+            the pool doesn't know about the job """
+        with self.lock:
+            for algorithm, jobs in self.pending.items():
+                for task in jobs:
+                    if task[0].job_uuid == uid:
+                        jobs.remove(task)
+                        self._release_edges(task[0])
+                        return True
+            for worker in self.workers:
+                if worker.job is not None and worker.job.job_uuid == uid:
+                    self._stop(worker, None)
+                    return True
+        return False
+
+    def _share_edges(self, job: Job, args: dict) -> dict:
+        """ Write the job's edge list for the worker to map, unless an earlier
+            job already has, and return the args to send in its place.  We
+            write the graph without holding the lock, since it can be large.
+            If we can't, the edge list is sent as before """
+        edges = args.get('edges')
+        if not self.graph_dir or not isinstance(edges, EdgeList):
+            return args
+        with self.lock:
+            shared = self.shared_edges.get(id(edges))
+            if shared is not None:
+                shared.jobs += 1
+            else:
+                self.shared_count += 1
+                path = os.path.join(self.graph_dir, '%d_%d_%d.edges' %
+                                    (os.getpid(), self.started, self.shared_count))
+        if shared is None:
+            try:
+                write_shared_edges(edges, path)
+            except OSError as e:
+                logging.warning('could not share the graph of job %s: %s', job.job_uuid, e)
+                return args
+            with self.lock:
+                shared = self.shared_edges.setdefault(id(edges), SharedEdges(edges, path))
+                shared.jobs += 1
+            if shared.path != path:
+                # Another job shared it first
+                remove_graph(path)
+        job.shared_edges = shared
+        args = dict(args, shared_edges=shared.path)
+        del args['edges']
+        return args
+
+    def _release_edges(self, job: Job):
+        """ The job is done with its edge list, which we remove once no other
+            job is using it.  Called with the lock held """
+        shared = job.shared_edges
+        if shared is None:
+            return
+        job.shared_edges = None
+        shared.jobs -= 1
+        if shared.jobs == 0:
+            del self.shared_edges[id(shared.edges)]
+            remove_graph(shared.path)
+
+    def _spawn(self, slot: int) -> Worker:
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=worker_main, name='pool-worker-%d' % slot,
+                                       args=(child_conn, self.services,
+                                             StatusWord(self.status_words, slot),
+                                             self.result_dir, self.preload,
+                                             self.memory_limits))
+        process.start()
+        child_conn.close()
+        return Worker(slot, process, parent_conn)
+
+    def _recycle(self, worker: Worker):
+        """ Kill a worker and replace it.  We do this after a job was stopped
+            or ran out of memory, since the libraries it was in the middle of
+            may not have cleaned up after themselves.  Called with the lock
+            held """
+        worker.process.kill()
+        worker.process.join()
+        self._replace(worker)
+
+    def _replace(self, worker: Worker):
+        """ Replace a dead worker with a fresh one.  Called with the lock held """
+        self._finished(worker)
+        worker.conn.close()
+        self.workers[worker.slot] = self._spawn(worker.slot)
+        self._dispatch()
+
+    def _finished(self, worker: Worker):
+        if worker.job is not None:
+            self.running[worker.job.algorithm] -= 1
+            worker.job.status_word = None
+            self._release_edges(worker.job)
+        worker.job = None
+        worker.deadline = None
+        worker.stop_deadline = None
+        worker.stop_state = None
+
+    def _stop(self, worker: Worker, state: str):
+        """ Ask a worker to stop its job, which ends in state ('timeout', or
+            None if it was cancelled).  This lets the job clean up after
+            itself, but only Python code notices, so if the worker hasn't
+            stopped within stop_grace we kill it.  Called with the lock held """
+        if worker.stop_deadline is not None:
+            return
+        worker.stop_state = state
+        worker.stop_deadline = time.time() + self.stop_grace
+        try:
+            os.kill(worker.process.pid, signal.SIGUSR1)
+        except ProcessLookupError:
+            pass
+
+    def _stopped(self, job: Job, state: str):
+        """ Finish a job that was stopped.  Called with the lock held """
+        if state is None:
+            # It was cancelled, and nobody wants to hear about it
+            return
+        error = 'job took longer than its limit of %g seconds' % self.timeouts[job.algorithm]
+        job.result = save_result(self.result_dir, job.job_uuid,
+                                 json.dumps({'error': error}).encode())
+        job.state = state
+        self._notify(job)
+
+    def _check_deadlines(self):
+        """ Stop the jobs that have run out of time, and kill the workers that
+            haven't stopped when asked.  Called with the lock held """
+        now = time.time()
+        for worker in list(self.workers):
+            if worker.job is None:
+                continue
+            if worker.stop_deadline is not None:
+                if now >= worker.stop_deadline:
+                    job = worker.job
+                    state = worker.stop_state
+                    logging.warning('killing worker %d, which did not stop job %s',
+                                    worker.slot, job.job_uuid)
+                    self._recycle(worker)
+                    self._stopped(job, state)
+            elif worker.deadline is not None and now >= worker.deadline:
+                self._stop(worker, 'timeout')
+
+    def _dispatch(self):
+        """ Hand pending jobs to idle workers.  Called with the lock held """
+        for worker in self.workers:
+            if worker.job is not None:
+                continue
+            task = self._next_task()
+            if task is None:
+                return
+            job, args = task
+            status_word = StatusWord(self.status_words, worker.slot)
+            status_word['status'] = 'queued'
+            job.status_word = status_word
+            if job.queued_at is not None:
+                job.stats['timings']['queue'] = time.time() - job.queued_at
+            worker.job = job
+            timeout = self.timeouts.get(job.algorithm, self.default_timeout)
+            if timeout > 0:
+                worker.deadline = time.time() + timeout
+            self.running[job.algorithm] += 1
+            worker.conn.send((job.job_uuid, job.algorithm, args))
+
+    def _next_task(self):
+        """ Take the next job from the first algorithm that is under its limit,
+            rotating that algorithm to the back of the line """
+        for algorithm, jobs in self.pending.items():
+            if jobs and self.running[algorithm] < self.limits.get(algorithm, self.default_limit):
+                self.pending.move_to_end(algorithm)
+                return jobs.popleft()
+        return None
+
+    def _collect(self):
+        """ Watch for finished jobs and dead workers """
+        while not self.stopping:
+            with self.lock:
+                self._check_deadlines()
+                workers = list(self.workers)
+            self._deliver()
+            handles = {}
+            for worker in workers:
+                handles[worker.conn] = worker
+                handles[worker.process.sentinel] = worker
+            try:
+                ready_list = wait(list(handles.keys()), timeout=0.5)
+            except (OSError, ValueError):
+                # A worker was replaced under us
+                continue
+            for ready in ready_list:
+                worker = handles[ready]
+                with self.lock:
+                    if self.stopping or self.workers[worker.slot] is not worker:
+                        continue
+                    if ready is worker.conn:
+                        try:
+                            message = worker.conn.recv()
+                        except (EOFError, OSError):
+                            continue
+                        job = worker.job
+                        if job is None or job.job_uuid != message[1]:
+                            continue
+                        if message[0] == 'running':
+                            job.worker = message[2]
+                            job.state = 'running'
+                            self._notify(job)
+                        elif message[0] == 'progress':
+                            job.progress = message[2]
+                            self._notify(job)
+                        elif message[0] == 'done':
+                            job.result = message[3]
+                            job.state = message[2]
+                            add_stats(job.stats, message[4])
+                            if job.state == 'oom':
+                                self._recycle(worker)
+                            else:
+                                self._finished(worker)
+                                self._dispatch()
+                            self._notify(job)
+                        elif message[0] == 'stopped':
+                            state = worker.stop_state
+                            add_stats(job.stats, message[2])
+                            self._recycle(worker)
+                            self._stopped(job, state)
+                    else:
+                        self._check_worker(worker)
+            self._deliver()
+
+    def check_workers(self):
+        """ Join and replace any workers that have died """
+        with self.lock:
+            if self.stopping:
+                return
+            for worker in list(self.workers):
+                self._check_worker(worker)
+        self._deliver()
+
+    def _check_worker(self, worker: Worker):
+        """ Join and replace a worker if it has died, failing its job.
+            Called with the lock held """
+        if worker.process.is_alive():
+            return
+        job = worker.job
+        logging.error('worker %d exited with %s while running job %s',
+                      worker.slot, worker.process.exitcode,
+                      job.job_uuid if job is not None else None)
+        worker.process.join()
+        exitcode = worker.process.exitcode
+        self._replace(worker)
+        if job is not None:
+            # The kernel's OOM killer sends SIGKILL
+            if exitcode == -signal.SIGKILL:
+                (state, error) = ('oom', 'worker was killed, most likely for running out of memory')
+            else:
+                (state, error) = ('failed', 'worker exited')
+            job.result = save_result(self.result_dir, job.job_uuid,
+                                     json.dumps({'error': error}).encode())
+            job.state = state
+            self._notify(job)
+
+    def _notify(self, job: Job):
+        """ Queue a change to a job for the listener.  Called with the lock
+            held """
+        if self.listener is not None:
+            self.events.append(job)
+
+    def _deliver(self):
+        """ Call the listener with each change queued.  It records them in
+            the job store, so we don't hold the lock while it does.  The
+            listener sees the job as it is now, which may be past the change,
+            so it must expect to hear about a finished job more than once """
+        with self.delivering:
+            while True:
+                try:
+                    job = self.events.popleft()
+                except IndexError:
+                    return
+                try:
+                    self.listener(job)
+                except Exception:
+                    logging.exception('listener failed for job %s', job.job_uuid)
+
+def save_result(result_dir: str, uid: UUID, result) -> str:
+    """ Write a job's encoded result, either bytes or an iterator of chunks of
+        bytes, where any process can fetch it, and return its location """
+    path = os.path.join(result_dir, str(uid)+'.json')
+    with open(path+'.tmp', 'wb') as f:
+        if isinstance(result, bytes):
+            f.write(result)
+        else:
+            for chunk in result:
+                f.write(chunk)
+    os.replace(path+'.tmp', path)
+    return path
+
+def make_private_directory(path: str):
+    """ Create a directory that only we can use, or check that an existing
+        one is.  The workers read the graphs and results we leave there, so
+        it mustn't be possible for anyone else to plant or swap them: the
+        directory must be ours, with mode 0700, and no one else may be able
+        to rename it.  Raises PermissionError if it isn't safe """
+    path = os.path.abspath(path)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise PermissionError(path+' is not a directory of our own')
+    if info.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    # Anyone who can write to a parent, such as /tmp/restapi, could replace
+    # the directory, unless the parent is sticky like /tmp
+    parent = os.path.dirname(path)
+    while True:
+        info = os.stat(parent)
+        if info.st_uid not in (0, os.getuid()) or (info.st_mode & 0o022 and
+                                                     not info.st_mode & stat.S_ISVTX):
+            raise PermissionError(parent+' can be changed by other users')
+        if parent == os.path.dirname(parent):
+            return
+        parent = os.path.dirname(parent)
+
+def remove_graph(path: str):
+    """ Remove a shared edge list.  Workers that still have it mapped keep
+        it until they are done with it """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def remove_stale_graphs(graph_dir: str):
+    """ Remove the shared edge lists of pools whose process has exited,
+        since it can't have removed them itself """
+    for name in os.listdir(graph_dir):
+        pid = name.split('_')[0]
+        if name.endswith('.edges') and pid.isdigit() and not pid_alive(int(pid)):
+            remove_graph(os.path.join(graph_dir, name))
+
+def add_stats(stats: dict, worker_stats: dict):
+    """ Add what the worker measured to a job's stats """
+    for (name, value) in worker_stats.items():
+        if name == 'timings':
+            stats['timings'].update(value)
+        else:
+            stats[name] = value
+
+def reset_peak_rss():
+    """ Start measuring the peak RSS afresh, so that each job gets its own
+        rather than the largest of any job the worker has run.  Only Linux
+        lets us do this """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def get_peak_rss() -> int:
+    """ The peak RSS of this process in bytes, since reset_peak_rss """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    # The peak over the life of the process, in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def progress_reporter(conn, uid: UUID):
+    """ Report a job's progress to the web process, but only when the whole
+        percentage changes, since igraph can report far more often """
+    last = [None]
+    def report(progress: float):
+        progress = int(progress)
+        if progress != last[0]:
+            last[0] = progress
+            conn.send(('progress', uid, progress))
+    return report
+
+def set_progress_handler(status: StatusWord) -> bool:
+    """ Send igraph's progress to our status word.  Returns False if igraph
+        hasn't been imported yet """
+    igraph = sys.modules.get('igraph')
+    if igraph is None:
+        return False
+    igraph.set_progress_handler(lambda message, percentage:
+                                status.__setitem__('progress', percentage))
+    return True
+
+def limit_memory(limit: int) -> tuple:
+    """ Limit the memory the worker can allocate, returning the previous
+        limit.  RLIMIT_DATA covers the heap and anonymous mappings, which is
+        where numpy and igraph allocate, but not the shared libraries """
+    previous = resource.getrlimit(resource.RLIMIT_DATA)
+    if limit > 0:
+        if previous[1] != resource.RLIM_INFINITY:
+            limit = min(limit, previous[1])
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, previous[1]))
+    return previous
+
+def worker_main(conn, services: dict, status: StatusWord, result_dir: str,
+                preload: list = (), memory_limits: dict = {}):
+    """ The worker loop: run jobs until we are told to stop.  The status goes
+        into our shared status word, and the result is written once to the
+        result directory and its location sent back over our pipe, as is any
+        progress the job reports, and what we measured about the job.
+        SIGUSR1 stops the job we are running """
+    stoppable = [False]
+    def stop(signum, frame):
+        if stoppable[0]:
+            stoppable[0] = False
+            raise JobStopped()
+    signal.signal(signal.SIGUSR1, stop)
+    set_status_words(status.words)
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            logging.warning('worker could not preload %s', name)
+    progress_handler = set_progress_handler(status)
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            break
+        if task is None:
+            break
+        uid, algorithm, args = task
+        if not progress_handler:
+            progress_handler = set_progress_handler(status)
+        conn.send(('running', uid, process_id()))
+        status.report = progress_reporter(conn, uid)
+        status.reset_phases()
+        reset_peak_rss()
+        result = {}
+        try:
+            previous_limit = limit_memory(memory_limits.get(algorithm, 0))
+            stoppable[0] = True
+            try:
+                if 'shared_edges' in args:
+                    args['edges'] = read_shared_edges(args.pop('shared_edges'))
+                services[algorithm].run(args, status, result)
+                status['phase'] = 'encode'
+                location = save_result(result_dir, uid,
+                                       services[algorithm].encode_result(args, result))
+                state = 'done'
+            finally:
+                stoppable[0] = False
+                resource.setrlimit(resource.RLIMIT_DATA, previous_limit)
+        except JobStopped:
+            state = None
+        except MemoryError:
+            logging.warning('job %s (%s) ran out of memory', uid, algorithm)
+            (state, error) = ('oom', 'job ran out of memory')
+        except Exception as e:
+            logging.exception('job %s (%s) failed', uid, algorithm)
+            (state, error) = ('failed', str(e))
+        status.report = None
+        stats = {'timings': status.end_phase(), 'peak_rss_bytes': get_peak_rss()}
+        if state is None:
+            conn.send(('stopped', uid, stats))
+            continue
+        if state != 'done':
+            location = save_result(result_dir, uid, json.dumps({'error': error}).encode())
+        status['status'] = state
+        conn.send(('done', uid, state, location, stats))
@@ -1,7 +1,6 @@
 #! /usr/local/bin/python3
 import falcon
-import scanpy as sc
-import pandas as pd
+import json
 import os
 import sys
 import shutil
@@ -9,156 +8,315 @@ import logging
 import warnings
 import pathlib
 import cgi
-import zipfile
 from urllib import parse
+from uuid import UUID
+
+from . import utils
+from .lazy import LazyModule
+from .datasets import DatasetCache, get_key, get_stage_key, get_upload_hash
+from .job import FINISHED
+from .jobs import Jobs
+from .pool import QueueFull
+
+# Only the workers need these
+sc = LazyModule('scanpy')
+pd = LazyModule('pandas')
+
+class ScNetVizService(object):
+    """ A scnetviz operation: preprocess a single cell dataset, then compute
+        an embedding or a clustering of it.  These run as jobs on the worker
+        pool, just like the igraph algorithms """
+    jobs = None
+    name = None
+    # The default number of neighbors, or None if we use the PCA instead
+    n_neighbors = None
+
+    def __init__(self, jobs: Jobs, datasets: DatasetCache):
+        self.jobs = jobs
+        self.datasets = datasets
+
+    def on_post(self, req: falcon.Request, resp: falcon.Response):
+        """ Queue a job and return its id """
+        try:
+            uuid = self.start_job(req)
+        except ValueError as e:
+            resp.status = falcon.HTTP_400
+            resp.body = json.dumps({'error': str(e)})
+            return
+        except QueueFull as e:
+            resp.status = falcon.HTTP_503
+            resp.set_header('Retry-After', str(e.retry_after))
+            resp.body = json.dumps({'error': str(e)})
+            return
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps({'job_id': str(uuid)})
 
-
-class ScNetVizHandler(object):
-    min_genes=100
-    min_cells=1
-    normalize=True
-    log1p=True
-    hvg=True
-    scale=True
-
-    def on_post(self, req, resp):
-        path = req.path
+    def start_job(self, req: falcon.Request) -> UUID:
+        """ Queue a job for the request.  Raises ValueError if the request is
+            bad and QueueFull if we can't take it """
         source = req.get_param('source')
         accession = req.get_param('accession')
-        #main()
         if (source is None or accession is None):
-            resp.code = falcon.HTTP_400_BAD_REQUEST
-            resp.body = {'error':"both source and accession must be specified"}
-            return
-
-        self.min_genes = get_param_as_int(req, 'min_genes', self.min_genes)
-        self.min_cells = get_param_as_int(req, 'min_cells', self.min_cells)
-        self.normalize = get_param_as_bool(req, 'normalize', True)
-        self.log1p = get_param_as_bool(req, 'log1p', True)
-        self.hvg = get_param_as_bool(req, 'hvg', True)
-        self.scale = get_param_as_bool(req, 'scale', True)
-
-        adata = None
+            raise ValueError("both source and accession must be specified")
+        matrixFile = req.get_param('file')
+        if matrixFile is None or isinstance(matrixFile, str):
+            raise ValueError("file must be a zip archive of the matrix")
+
+        args = self.get_args(req)
+        args['source'] = source
+        args['accession'] = accession
+        # The dataset is filtered as it is read, so its key includes the filters
+        args['dataset_key'] = get_stage_key(get_key(get_upload_hash(matrixFile.file), source, accession),
+                                            'filter', {'min_genes': args['min_genes'],
+                                                       'min_cells': args['min_cells']})
+        # The worker can't read the request, so unless we have the dataset
+        # already it gets a copy of the upload
+        args['upload'] = None
+        if not self.datasets.contains(args['dataset_key']):
+            args['upload'] = self.datasets.save_upload(matrixFile.file)
+
+        uuid = self.jobs.create_job(req.path, self)
         try:
-            if path.endswith('/umap'):
-                adata = self.handle_umap(req, resp, source, accession)
-            elif path.endswith('/tsne'):
-                adata = self.handle_tsne(req, resp, source, accession)
-            elif path.endswith('/drawgraph'):
-                adata = self.handle_tsne(req, resp, source, accession)
-            elif path.endswith('/leiden'):
-                adata = self.handle_tsne(req, resp, source, accession)
-            elif path.endswith('/louvain'):
-                adata = self.handle_tsne(req, resp, source, accession)
-        except Exception as e:
-            resp.status = falcon.HTTP_500
-            resp.body = {'error': str(e)}
-            return
-
-        resp.status = falcon.HTTP_200
-
-        # Note that we add the extra newline for compatability
-        resp.body = adata.to_csv(header=None)+'\n'
-        return
-
-
-
-    def handle_umap(self, req, resp, source, accession):
+            self.jobs.submit(uuid, args)
+        except QueueFull:
+            self.jobs.remove_job(uuid)
+            self.datasets.remove_upload(args['upload'])
+            raise
+        return uuid
+
+    def get_args(self, req: falcon.Request) -> dict:
+        """ Get the preprocessing parameters that all of the operations share """
+        args = {}
+        args['min_genes'] = get_param_as_int(req, 'min_genes', 100)
+        args['min_cells'] = get_param_as_int(req, 'min_cells', 1)
+        args['normalize'] = get_param_as_bool(req, 'normalize', True)
+        args['log1p'] = get_param_as_bool(req, 'log1p', True)
+        args['hvg'] = get_param_as_bool(req, 'hvg', True)
+        args['scale'] = get_param_as_bool(req, 'scale', True)
+        args['n_neighbors'] = get_param_as_int(req, 'n_neighbors', self.n_neighbors)
+        args['output'] = get_param_as_string(req, 'output', 'csv')
+        if args['output'] not in ('csv', 'binary'):
+            raise ValueError("output must be csv or binary")
+        return args
+
+    def run(self, args: dict, status: dict, result: dict):
+        """ Run the job on a worker """
+        status['status'] = 'running'
+        status['phase'] = 'preprocess'
+        try:
+            adata = self.get_preprocessed(args)
+        finally:
+            self.datasets.remove_upload(args['upload'])
+        status['phase'] = 'compute'
+        result['data'] = self.compute(adata, args)
+        status['status'] = 'done'
+
+    def compute(self, adata, args: dict):
+        """ The final step: returns a DataFrame of coordinates, or a Series of
+            clusters, indexed by cell """
+        raise NotImplementedError
+
+    def encode_result(self, args: dict, result: dict):
+        """ Encode the result in chunks, so that a large embedding is never
+            held as one string """
+        data = result['data']
+        if args['output'] == 'binary':
+            if isinstance(data, pd.Series):
+                return [utils.get_binary_membership(list(data.index),
+                                                    data.astype('category').cat.codes)]
+            return utils.iter_binary_embedding(list(data.index), data.values)
+        return iter_csv(data)
+
+    def get_preprocessed(self, args: dict):
+        """ Get the dataset ready for the final step: preprocessed, then with
+            either its neighbor graph or, without n_neighbors, its PCA.  Each
+            stage is cached under the dataset and the parameters that went
+            into it, so the operations share all but their final step """
+        n_neighbors = args['n_neighbors']
+        preprocess_key = get_stage_key(args['dataset_key'], 'preprocess',
+                                       {'normalize': args['normalize'], 'log1p': args['log1p'],
+                                        'hvg': args['hvg'], 'scale': args['scale']})
+        if n_neighbors is None:
+            key = get_stage_key(preprocess_key, 'pca', {})
+        else:
+            key = get_stage_key(preprocess_key, 'neighbors', {'n_neighbors': n_neighbors})
+        adata = self.datasets.load(key)
+        if adata is not None:
+            return adata
+
+        adata = self.datasets.load(preprocess_key)
+        if adata is None:
+            adata = self.datasets.load_upload(args['dataset_key'], args['upload'],
+                                              args['source'], args['accession'],
+                                              min_genes=args['min_genes'],
+                                              min_cells=args['min_cells'])
+            adata = normalize_counts(adata, normalize=args['normalize'],
+                                     log1p=args['log1p'],
+                                     hvg=args['hvg'],
+                                     scale=args['scale'])
+            self.datasets.put(preprocess_key, adata)
+        adata = reduce_dimensions(adata, n_neighbors=n_neighbors)
+        self.datasets.put(key, adata)
+        return adata
+
+    def get_status(self, uid: UUID) -> str:
+        return self.jobs.check_job(uid)
+
+    def fetch_results(self, uid: UUID, req: falcon.Request, resp: falcon.Response):
+        (status, f) = self.jobs.open_result(uid)
+        if status == 'done' and f is not None:
+            send_result(resp, f)
+            resp.status = falcon.HTTP_200
+        elif status is not None:
+            result = None
+            if f is not None:
+                with f:
+                    result = f.read()
+            resp.data = utils.get_json_result({'status': status,
+                                               'stats': self.jobs.get_stats(uid)}, result)
+            resp.status = falcon.HTTP_200
+        else:
+            resp.status = falcon.HTTP_400
+            resp.body = json.dumps({'error': "no such job: "+str(uid)})
+
+    def terminate(self, uid: UUID, req: falcon.Request, resp: falcon.Response):
+        if self.jobs.terminate(uid):
+            resp.body = "Job: "+str(uid)+" terminated"
+            resp.status = falcon.HTTP_200
+        else:
+            resp.status = falcon.HTTP_400
+            resp.body = json.dumps({'error': "no such job: "+str(uid)})
+
+class UmapService(ScNetVizService):
+    n_neighbors = 10
+
+    def get_args(self, req: falcon.Request) -> dict:
         # umap arguments
         # scanpy.tl.umap(adata, min_dist=0.5, spread=1.0, n_components=2, maxiter=None, 
         #                alpha=1.0, gamma=1.0, negative_sample_rate=5, init_pos='spectral', 
         #                random_state=0, a=None, b=None, copy=False)
         #
-        print('umap')
-        n_neighbors = get_param_as_int(req, 'n_neighbors', 10)
-        min_dist = get_param_as_float(req, 'min_dist', 0.5)
-
-        print('getting file')
-        adata = get_file(source, accession, req.get_param('file'))
-        print('preprocessing')
-        adata = preprocess(adata, n_neighbors=n_neighbors,
-                           min_genes=self.min_genes,
-                           min_cells=self.min_cells,
-                           normalize=self.normalize,
-                           log1p=self.log1p,
-                           hvg=self.hvg,
-                           scale=self.scale)
-        print('calculating')
-        sc.tl.umap(adata, min_dist=min_dist)
-        print('returning')
+        args = super().get_args(req)
+        args['min_dist'] = get_param_as_float(req, 'min_dist', 0.5)
+        return args
+
+    def compute(self, adata, args: dict):
+        sc.tl.umap(adata, min_dist=args['min_dist'])
         return pd.DataFrame(adata.obsm['X_umap'], index=adata.obs_names)
 
-    def handle_tsne(self, req, resp, source, accession):
+class TsneService(ScNetVizService):
+    def get_args(self, req: falcon.Request) -> dict:
         # tSNE arguments
         #  scanpy.tl.tsne(adata, n_pcs=None, use_rep=None, perplexity=30, early_exaggeration=12, 
         #                 learning_rate=1000, random_state=0, use_fast_tsne=True, n_jobs=None, copy=False)
         #
-        adata = get_file(source, accession, req.get_param('file'))
-        adata = preprocess(adata,
-                           min_genes=self.min_genes,
-                           min_cells=self.min_cells,
-                           normalize=self.normalize,
-                           log1p=self.log1p,
-                           hvg=self.hvg,
-                           scale=self.scale)
-        n_pcs = get_param_as_int(req, 'n_pcs', None)
-        perplexity = get_param_as_float(req, 'perplexity', 30.0)
-        learning_rate = get_param_as_float(req, 'learning_rate', 1000.0)
-        early_exaggeration = get_param_as_float(req, 'early_exaggeration', 12.0)
-
-        sc.tl.tsne(adata, n_pcs=n_pcs, perplexity=perplexity, learning_rate=learning_rate, 
-                   early_exaggeration=early_exaggeration)
+        args = super().get_args(req)
+        args['n_pcs'] = get_param_as_int(req, 'n_pcs', None)
+        args['perplexity'] = get_param_as_float(req, 'perplexity', 30.0)
+        args['learning_rate'] = get_param_as_float(req, 'learning_rate', 1000.0)
+        args['early_exaggeration'] = get_param_as_float(req, 'early_exaggeration', 12.0)
+        # t-SNE works from the PCA
+        args['n_neighbors'] = None
+        return args
+
+    def compute(self, adata, args: dict):
+        sc.tl.tsne(adata, n_pcs=args['n_pcs'], perplexity=args['perplexity'],
+                   learning_rate=args['learning_rate'],
+                   early_exaggeration=args['early_exaggeration'])
         return pd.DataFrame(adata.obsm['X_tsne'], index=adata.obs_names)
 
-    def handle_drawgraph(self, req, resp, source, accession):
+class DrawGraphService(ScNetVizService):
+    n_neighbors = 10
+
+    def get_args(self, req: falcon.Request) -> dict:
         # draw_graph arguments
         #  scanpy.tl.draw_graph(adata, layout='fa', init_pos=None, root=None, random_state=0, 
         #                       n_jobs=None, adjacency=None, key_added_ext=None, copy=False, **kwds)
-        n_neighbors = get_param_as_int(req, 'n_neighbors', 10)
-        layout = get_param_as_string(req, 'layout', 'fr')
-
-        adata = get_file(source, accession, req.get_param('file'))
-        adata = preprocess(adata, n_neighbors=n_neighbors,
-                           min_genes=self.min_genes,
-                           min_cells=self.min_cells,
-                           normalize=self.normalize,
-                           log1p=self.log1p,
-                           hvg=self.hvg,
-                           scale=self.scale)
+        args = super().get_args(req)
+        args['layout'] = get_param_as_string(req, 'layout', 'fr')
+        return args
+
+    def compute(self, adata, args: dict):
+        layout = args['layout']
         sc.tl.draw_graph(adata, layout=layout)
         return pd.DataFrame(adata.obsm['X_draw_graph_'+layout], index=adata.obs_names)
 
-    def handle_louvain(self, req, resp, source, accession):
-        # louvain arguments
-        #  scanpy.tl.louvain(adata, resolution=None, random_state=0, restrict_to=None, 
-        #                    key_added='louvain', adjacency=None, flavor='vtraag', directed=True, 
-        #                    use_weights=False, partition_type=None, partition_kwargs=None, copy=False)
-        #
-        n_neighbors = get_param_as_int(req, 'n_neighbors', 15)
-        adata = get_file(source, accession, req.get_param('file'))
-        adata = preprocess(adata, n_neighbors=n_neighbors,
-                           min_genes=self.min_genes,
-                           min_cells=self.min_cells,
-                           normalize=self.normalize,
-                           log1p=self.log1p,
-                           hvg=self.hvg,
-                           scale=self.scale)
+class LouvainService(ScNetVizService):
+    # louvain arguments
+    #  scanpy.tl.louvain(adata, resolution=None, random_state=0, restrict_to=None, 
+    #                    key_added='louvain', adjacency=None, flavor='vtraag', directed=True, 
+    #                    use_weights=False, partition_type=None, partition_kwargs=None, copy=False)
+    #
+    n_neighbors = 15
+
+    def compute(self, adata, args: dict):
         sc.tl.louvain(adata)
         return adata.obs['louvain']
 
-    def handle_leiden(self, req, resp, source, accession):
-        n_neighbors = get_param_as_int(req, 'n_neighbors', 15)
-        adata = get_file(source, accession, req.get_param('file'))
-        adata = preprocess(adata, n_neighbors=n_neighbors,
-                           min_genes=self.min_genes,
-                           min_cells=self.min_cells,
-                           normalize=self.normalize,
-                           log1p=self.log1p,
-                           hvg=self.hvg,
-                           scale=self.scale)
+class LeidenService(ScNetVizService):
+    n_neighbors = 15
+
+    def compute(self, adata, args: dict):
         sc.tl.leiden(adata)
         return adata.obs['leiden']
 
+# The operations, by the last part of their routes
+SERVICES = {'umap': UmapService, 'tsne': TsneService, 'drawgraph': DrawGraphService,
+            'louvain': LouvainService, 'leiden': LeidenService}
+
+class ScNetVizHandler(object):
+    """ The original, synchronous routes.  These queue a job like any other,
+        wait for it, and answer with its result """
+
+    def __init__(self, service: ScNetVizService):
+        self.service = service
+        self.jobs = service.jobs
+
+    def on_post(self, req, resp):
+        try:
+            uid = self.service.start_job(req)
+        except ValueError as e:
+            resp.status = falcon.HTTP_400
+            resp.body = json.dumps({'error': str(e)})
+            return
+        except QueueFull as e:
+            resp.status = falcon.HTTP_503
+            resp.set_header('Retry-After', str(e.retry_after))
+            resp.body = json.dumps({'error': str(e)})
+            return
+
+        state = self.jobs.check_job(uid)
+        while state is not None and state not in FINISHED:
+            state = self.jobs.wait_for_change(uid, state, self.jobs.max_wait)
+        (state, f) = self.jobs.open_result(uid)
+        # Nobody will ask for this job again.  The file we have open stays
+        # readable until we have sent it
+        self.jobs.remove_job(uid)
+
+        if state == 'done' and f is not None:
+            resp.status = falcon.HTTP_200
+            send_result(resp, f)
+            return
+        resp.status = falcon.HTTP_500
+        if f is not None:
+            with f:
+                resp.data = f.read()
+        else:
+            resp.body = json.dumps({'error': 'job was terminated'})
+
+def send_result(resp: falcon.Response, f):
+    """ Stream a finished job's result from its file """
+    resp.content_type = utils.get_content_type(f, 'text/csv')
+    resp.content_length = os.fstat(f.fileno()).st_size
+    resp.stream = f
+
+def iter_csv(data):
+    """ Write a DataFrame or Series as CSV, a chunk of rows at a time """
+    for start in range(0, len(data), utils.CHUNK_ROWS):
+        yield data.iloc[start:start+utils.CHUNK_ROWS].to_csv(header=None).encode()
+    # Note that we add the extra newline for compatability
+    yield b'\n'
+
 
 def get_param_as_string(req, param, default):
     if req.has_param(param):
@@ -184,30 +342,8 @@ def get_param_as_bool(req, param, default):
     else:
         return default
 
-def get_file(source, accession, matrixFile):
-    matrix = zipfile.ZipFile(matrixFile.file, 'r')
-    #matrix = zipfile.ZipFile(matrixFile, 'r')
-
-    matrix.extractall("/tmp")
-    filePath = "/tmp/"+source+"/"+accession
-    adata = sc.read_10x_mtx(filePath, var_names="gene_symbols", cache=True)
-    #shutil.rmtree(filePath)
-
-    return adata
-
-def preprocess(adata, n_neighbors=None, min_genes=100, min_cells=1, 
-               normalize=True, log1p=True, 
-               hvg=True, scale=True):
-
-    # Filter options:
-    # scanpy.pp.filter_cells(data, min_counts=None, min_genes=None, max_counts=None, 
-    #                        max_genes=None, inplace=True, copy=False)
-    # scanpy.pp.filter_genes(data, min_counts=None, min_cells=None, max_counts=None, 
-    #                        max_cells=None, inplace=True, copy=False)
-    #
-    sc.pp.filter_cells(adata, min_genes=min_genes)
-    sc.pp.filter_genes(adata, min_cells=min_cells)
-
+def normalize_counts(adata, normalize=True, log1p=True,
+                     hvg=True, scale=True):
     # normalization options
     #  scanpy.pp.normalize_total(adata, target_sum=None, exclude_highly_expressed=False, 
     #                            max_fraction=0.05, key_added=None, layers=None, layer_norm=None, 
@@ -231,6 +367,12 @@ def preprocess(adata, n_neighbors=None, min_genes=100, min_cells=1,
     if scale is True:
         sc.pp.scale(adata, max_value=10)
 
+    # Don't hand on a view of the data we've thrown away
+    if adata.is_view:
+        adata = adata.copy()
+    return adata
+
+def reduce_dimensions(adata, n_neighbors=None):
     if (n_neighbors != None):
         # neighbors options:
         #  scanpy.pp.neighbors(adata, n_neighbors=15, n_pcs=None, use_rep=None, knn=True, 
@@ -0,0 +1,284 @@
+"""
+The job store: the record of every job, shared by all of the web processes
+(and all of the nodes) that serve the API
+"""
+
+import abc
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from uuid import UUID
+
+from . import config
+from .job import FINISHED
+
+def process_id() -> str:
+    """ Identify this process across the whole cluster """
+    return socket.gethostname()+':'+str(os.getpid())
+
+def process_alive(process: str) -> bool:
+    """ Is a process, as named by process_id, still running?  We can only tell
+        for processes on our own host, so we assume the others are """
+    (host, pid) = process.rsplit(':', 1)
+    if host != socket.gethostname():
+        return True
+    return pid_alive(int(pid))
+
+def pid_alive(pid: int) -> bool:
+    """ Is a process on this host still running? """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class JobStore(metaclass=abc.ABCMeta):
+    """ Interface for all job stores.  A job record is a dict with the keys
+        job_id, algorithm, state, owner (the web process that queued it),
+        worker (the process running it), result (the location of the result),
+        size (of the result in bytes), cancel (set when someone asks for the
+        job to be terminated), created, updated, finished and fetched (the
+        last time the result was fetched).  A batch is an ordered list of
+        job ids.  The stats of finished jobs are kept apart from the jobs, so
+        that they outlive the jobs' results """
+
+    @abc.abstractmethod
+    def create(self, job_uuid: UUID, algorithm: str, owner: str):
+        """ Add a new, queued job """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, job_uuid: UUID) -> dict:
+        """ Get a job record, or None if there is no such job """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update(self, job_uuid: UUID, **fields):
+        """ Update some of the fields of a job record """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, job_uuid: UUID):
+        """ Forget about a job """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def cancelled(self, owner: str) -> list:
+        """ The ids of the jobs queued by owner that someone asked to terminate """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def unfinished(self) -> list:
+        """ (job id, owner) of every job that is queued or running """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def expired(self, fetched_before: float, finished_before: float) -> list:
+        """ The ids of the finished jobs that were last fetched before fetched_before,
+            or that were never fetched and finished before finished_before """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def least_recently_used(self) -> list:
+        """ (job id, result size) of every finished job, least recently fetched
+            (or finished) first """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_batch(self, batch_uuid: UUID, job_uuids: list):
+        """ Record a batch of jobs """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_batch(self, batch_uuid: UUID) -> list:
+        """ The ids of the jobs in a batch, in order, or None if there is no
+            such batch.  Jobs that have since been removed are still listed """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove_empty_batches(self):
+        """ Forget the batches whose jobs have all been removed """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def counts(self) -> dict:
+        """ The number of jobs in each state, plus the total size of the
+            retained results as 'retained_bytes' """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def algorithm_counts(self) -> dict:
+        """ The number of jobs of each algorithm in each state, by
+            (algorithm, state) """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def record_stats(self, job_uuid: UUID, algorithm: str, state: str, stats: dict):
+        """ Record the stats of a finished job """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_stats(self, job_uuid: UUID) -> dict:
+        """ The stats of a finished job, or None if we don't have them """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def recent_stats(self, algorithm: str = None, limit: int = 100) -> list:
+        """ The stats records (job_id, algorithm, state, finished and stats)
+            of the most recently finished jobs, of one algorithm or all of
+            them, newest first """
+        raise NotImplementedError
+
+class SQLiteJobStore(JobStore):
+    """ A job store in an SQLite database.  Every process that opens the same
+        file sees the same jobs """
+    FIELDS = ('job_id', 'algorithm', 'state', 'owner', 'worker', 'result', 'size',
+              'cancel', 'created', 'updated', 'finished', 'fetched')
+    # Columns added since the first version of the table
+    COLUMNS = (('size', 'INTEGER'), ('finished', 'REAL'), ('fetched', 'REAL'))
+    FINISHED = '('+', '.join("'"+state+"'" for state in FINISHED)+')'
+
+    def __init__(self, path: str = None):
+        self.path = path or config.get_string('JOB_STORE', '/tmp/restapi/jobs.sqlite')
+        # The number of jobs we keep the stats of
+        self.keep_stats = config.get_int('KEEP_STATS', 10000)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.local = threading.local()
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                       'job_id TEXT PRIMARY KEY, algorithm TEXT, state TEXT, '
+                       'owner TEXT, worker TEXT, result TEXT, cancel INTEGER DEFAULT 0, '
+                       'created REAL, updated REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS batches ('
+                       'batch_id TEXT, position INTEGER, job_id TEXT, '
+                       'PRIMARY KEY (batch_id, position))')
+            db.execute('CREATE TABLE IF NOT EXISTS stats ('
+                       'job_id TEXT PRIMARY KEY, algorithm TEXT, state TEXT, '
+                       'finished REAL, stats TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS stats_finished ON stats (finished)')
+            columns = [row[1] for row in db.execute('PRAGMA table_info(jobs)')]
+            for (name, kind) in self.COLUMNS:
+                if name not in columns:
+                    db.execute('ALTER TABLE jobs ADD COLUMN '+name+' '+kind)
+
+    def connect(self) -> sqlite3.Connection:
+        """ Get this thread's connection.  Connections are per thread and per
+            process, since neither may be shared """
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def create(self, job_uuid: UUID, algorithm: str, owner: str):
+        now = time.time()
+        with self.connect() as db:
+            db.execute('INSERT INTO jobs (job_id, algorithm, state, owner, created, updated) '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       (str(job_uuid), algorithm, 'queued', owner, now, now))
+
+    def get(self, job_uuid: UUID) -> dict:
+        row = self.connect().execute('SELECT '+', '.join(self.FIELDS)+' FROM jobs '
+                                     'WHERE job_id = ?', (str(job_uuid),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(self.FIELDS, row))
+
+    def update(self, job_uuid: UUID, **fields):
+        fields['updated'] = time.time()
+        names = ', '.join(name+' = ?' for name in fields)
+        with self.connect() as db:
+            db.execute('UPDATE jobs SET '+names+' WHERE job_id = ?',
+                       tuple(fields.values())+(str(job_uuid),))
+
+    def remove(self, job_uuid: UUID):
+        with self.connect() as db:
+            db.execute('DELETE FROM jobs WHERE job_id = ?', (str(job_uuid),))
+
+    def cancelled(self, owner: str) -> list:
+        rows = self.connect().execute('SELECT job_id FROM jobs WHERE owner = ? AND cancel = 1',
+                                      (owner,)).fetchall()
+        return [UUID(row[0]) for row in rows]
+
+    def unfinished(self) -> list:
+        rows = self.connect().execute('SELECT job_id, owner FROM jobs WHERE state NOT IN '+
+                                      self.FINISHED).fetchall()
+        return [(UUID(job_id), owner) for (job_id, owner) in rows]
+
+    def expired(self, fetched_before: float, finished_before: float) -> list:
+        rows = self.connect().execute('SELECT job_id FROM jobs WHERE state IN '+self.FINISHED+
+                                      ' AND (fetched < ? OR (fetched IS NULL AND finished < ?))',
+                                      (fetched_before, finished_before)).fetchall()
+        return [UUID(row[0]) for row in rows]
+
+    def least_recently_used(self) -> list:
+        rows = self.connect().execute('SELECT job_id, size FROM jobs WHERE state IN '+
+                                      self.FINISHED+' ORDER BY COALESCE(fetched, finished)')
+        return [(UUID(job_id), size or 0) for (job_id, size) in rows.fetchall()]
+
+    def create_batch(self, batch_uuid: UUID, job_uuids: list):
+        with self.connect() as db:
+            db.executemany('INSERT INTO batches (batch_id, position, job_id) VALUES (?, ?, ?)',
+                           [(str(batch_uuid), position, str(job_uuid))
+                            for (position, job_uuid) in enumerate(job_uuids)])
+
+    def get_batch(self, batch_uuid: UUID) -> list:
+        rows = self.connect().execute('SELECT job_id FROM batches WHERE batch_id = ? '
+                                      'ORDER BY position', (str(batch_uuid),)).fetchall()
+        if len(rows) == 0:
+            return None
+        return [UUID(row[0]) for row in rows]
+
+    def remove_empty_batches(self):
+        with self.connect() as db:
+            db.execute('DELETE FROM batches WHERE batch_id NOT IN (SELECT batches.batch_id '
+                       'FROM batches JOIN jobs ON batches.job_id = jobs.job_id)')
+
+    def counts(self) -> dict:
+        db = self.connect()
+        counts = dict(db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        counts['retained_bytes'] = db.execute('SELECT COALESCE(SUM(size), 0) FROM jobs WHERE '
+                                              'state IN '+self.FINISHED).fetchone()[0]
+        return counts
+
+    def algorithm_counts(self) -> dict:
+        rows = self.connect().execute('SELECT algorithm, state, COUNT(*) FROM jobs '
+                                      'GROUP BY algorithm, state').fetchall()
+        return {(algorithm, state): count for (algorithm, state, count) in rows}
+
+    def record_stats(self, job_uuid: UUID, algorithm: str, state: str, stats: dict):
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO stats (job_id, algorithm, state, finished, stats) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (str(job_uuid), algorithm, state, time.time(), json.dumps(stats)))
+            # Forget the oldest once we have too many
+            db.execute('DELETE FROM stats WHERE finished < (SELECT finished FROM stats '
+                       'ORDER BY finished DESC LIMIT 1 OFFSET ?)', (self.keep_stats-1,))
+
+    def get_stats(self, job_uuid: UUID) -> dict:
+        row = self.connect().execute('SELECT stats FROM stats WHERE job_id = ?',
+                                     (str(job_uuid),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def recent_stats(self, algorithm: str = None, limit: int = 100) -> list:
+        query = 'SELECT job_id, algorithm, state, finished, stats FROM stats'
+        params = ()
+        if algorithm is not None:
+            query += ' WHERE algorithm = ?'
+            params = (algorithm,)
+        rows = self.connect().execute(query+' ORDER BY finished DESC LIMIT ?',
+                                      params+(limit,)).fetchall()
+        return [{'job_id': job_id, 'algorithm': algorithm, 'state': state,
+                 'finished': finished, 'stats': json.loads(stats)}
+                for (job_id, algorithm, state, finished, stats) in rows]
@@ -2,8 +2,35 @@
 Various utility functions
 """
 
-import igraph as ig
+# igraph is imported lazily, so the annotations mustn't be evaluated
+from __future__ import annotations
+
 import json
+import numpy as np
+import random
+import struct
+
+from .edgelist import EdgeList, encode_names, read_json_edges
+from .lazy import LazyModule
+
+ig = LazyModule('igraph')
+pd = LazyModule('pandas')
+
+# The ways a partition can be returned: as lists of node names, as a
+# membership vector aligned to a node name table, or as that in binary
+OUTPUTS = ('partitions', 'membership', 'binary')
+
+# The binary membership format is a 32 byte little-endian header (magic,
+# version, flags, cluster count, node count, name table size), the name table
+# as in the binary edge list, then the int32 cluster of each node
+MEMBERSHIP_TYPE = 'application/x-membership'
+MEMBERSHIP_MAGIC = b'RBMV'
+MEMBERSHIP_HEADER = struct.Struct('<4sIIIQQ')
+EMBEDDING_TYPE = 'application/x-embedding'
+EMBEDDING_MAGIC = b'RBEM'
+EMBEDDING_HEADER = struct.Struct('<4sIIIQQ')
+# Rows encoded at a time when a result is written in chunks
+CHUNK_ROWS = 65536
 
 
 def get_param_as_string(req, param, default):
@@ -27,43 +54,147 @@ def get_param_as_int(req, param, default):
 def get_param_as_bool(req, param, default):
     if req.has_param(param):
         return req.get_param_as_bool(param)
+    else:
+        return default
+
+def set_seed(seed: int):
+    """ Seed the random number generator igraph uses, if we were given a seed """
+    if seed is not None:
+        random.seed(seed)
 
 def get_graph(json_data: str) -> ig.Graph:
     """ Convert a json string to a dictionary of
-        vertices and edges """
-    vertices = json_data['nodes']
-    edges = json_data['edges']
-    ncol = []
-    for edge in edges:
-        ncol.append((edge[0],edge[1],float(edge[2])))
+        vertices and edges.  The node names are factorized into integer
+        ids in one vectorized pass, numbered in order of first appearance
+        just as Graph.TupleList would do """
+    edges = np.array(json_data['edges'], dtype=object)
+    if len(edges) == 0:
+        return ig.Graph.TupleList([], edge_attrs="weights")
+    (ids, names) = pd.factorize(edges[:, :2].ravel())
+    weights = edges[:, 2].astype(np.float64)
+    return get_graph_from_arrays(names, ids.reshape(-1, 2), weights)
 
-    g = ig.Graph.TupleList(ncol,edge_attrs="weights")
+def get_graph_from_arrays(names, edges: np.ndarray, weights: np.ndarray) -> ig.Graph:
+    """ Build the graph from a node name table, an (m, 2) array of
+        node ids and an array of weights """
+    g = ig.Graph(n=len(names), edges=edges)
+    g.es['weights'] = weights.tolist()
+    g.vs['name'] = list(names)
     return g
 
+def get_edge_list_graph(edge_list: EdgeList) -> ig.Graph:
+    """ Build the graph from a parsed edge list """
+    return get_graph_from_arrays(edge_list.names, edge_list.get_edges(),
+                                 edge_list.get_weights())
+
 def get_json_graph(data: str) -> ig.Graph:
     """ Convert a json data stream to a dictionary of
         vertices and edges """
-    json_data = json.load(data)
-    return get_graph(json_data)
-
-def get_json_result(status: dict, result: dict) -> str:
-    json_data = {}
-    for key, value in status.items():
-        json_data[key] = value
-    for key, value in result.items():
-        json_data[key] = value
-
-    return json.dumps(json_data)
-
-def get_vertex_list(graph: ig.Graph, vertices: list) -> list:
-    """ Take a list (or list of lists) of vertex indices and return a
-        list (or list of lists) of vertex names """
-    result = []
-    for vals in vertices:
-        if isinstance(vals, list):
-            result.append(get_vertex_list(graph, vals))
-        elif isinstance(vals, str):
-            result.append(vals)
-        elif isinstance(vals, int):
-            result.append(graph.vs[vals]['name'])
-    return result
+    return get_edge_list_graph(read_json_edges(data))
+
+def get_json_result(status: dict, result: bytes) -> bytes:
+    """ Merge the status into a result that the worker has already
+        encoded as a JSON object, without decoding it again """
+    json_status = json.dumps(status).encode()
+    if result is None or result.strip() == b'{}':
+        return json_status
+    return json_status[:-1] + b', ' + result.lstrip()[1:]
+
+def add_partition(result: dict, graph: ig.Graph, part, output: str = 'partitions'):
+    """ Add a partition (a VertexClustering) of graph to the result in the
+        requested output format.  The names are looked up once for the whole
+        graph rather than once per vertex """
+    membership = part.membership
+    if output == 'partitions':
+        result['partitions'] = get_partitions(graph.vs['name'], membership)
+    else:
+        result['nodes'] = graph.vs['name']
+        result['membership'] = membership
+
+def get_partitions(names: list, membership: list) -> list:
+    """ Group the names into one list per cluster, each in vertex order
+        just as VertexClustering lists them """
+    if len(membership) == 0:
+        return []
+    membership = np.asarray(membership)
+    order = np.argsort(membership, kind='stable')
+    sorted_names = np.asarray(names, dtype=object)[order]
+    bounds = np.flatnonzero(np.diff(membership[order])) + 1
+    return [cluster.tolist() for cluster in np.split(sorted_names, bounds)]
+
+def get_result_membership(result: bytes, names: list) -> np.ndarray:
+    """ The membership vector in an encoded result, whichever output it was
+        in, aligned with names (the node name table of the job's graph).
+        Nodes the result doesn't mention get clusters of their own """
+    if result.startswith(MEMBERSHIP_MAGIC):
+        (magic, version, flags, clusters, nodes, names_size) = MEMBERSHIP_HEADER.unpack_from(result)
+        return np.frombuffer(result, dtype='<i4', count=nodes,
+                             offset=MEMBERSHIP_HEADER.size+names_size).astype(np.int64)
+    data = json.loads(result)
+    if 'membership' in data:
+        membership = np.asarray(data['membership'], dtype=np.int64)
+        if 'nodes' in data:
+            # Align it with our name table, which it should match anyway
+            ids = pd.Index(data['nodes']).get_indexer(names)
+            membership = np.where(ids >= 0, membership[ids], -1)
+    elif 'partitions' in data:
+        partitions = data['partitions']
+        members = [name for partition in partitions for name in partition]
+        clusters = np.repeat(np.arange(len(partitions)), [len(p) for p in partitions])
+        ids = pd.Index(names).get_indexer(members)
+        membership = np.full(len(names), -1, dtype=np.int64)
+        membership[ids[ids >= 0]] = clusters[ids >= 0]
+    else:
+        raise ValueError('the result has no partition')
+    missing = membership < 0
+    first = membership.max() + 1 if len(membership) > 0 else 0
+    membership[missing] = first + np.arange(np.count_nonzero(missing))
+    return membership
+
+def get_co_assignment(edges: np.ndarray, memberships: list) -> np.ndarray:
+    """ For each of an (m, 2) array of edges, the fraction of the
+        partitions, given as membership arrays, that put its ends in the same
+        cluster """
+    memberships = np.vstack(memberships)
+    return (memberships[:, edges[:, 0]] == memberships[:, edges[:, 1]]).mean(axis=0)
+
+def get_stability(edges: np.ndarray, memberships: list) -> float:
+    """ How much the partitions agree, from 0 to 1: over the edges, the
+        mean of (2p-1)^2, where p is the fraction of the partitions that put
+        the edge's ends together.  It is 1 when they all agree about every
+        edge, and 0 when they are split evenly about every edge """
+    if len(edges) == 0:
+        return 1.0
+    return float(np.mean((2*get_co_assignment(edges, memberships) - 1)**2))
+
+def get_binary_membership(names: list, membership: list) -> bytes:
+    """ Encode a membership vector and its name table in binary.  Without
+        names the table is empty, and the client aligns the vector with the
+        nodes in the order they first appeared in its upload """
+    table = encode_names(names) if names is not None else b''
+    membership = np.asarray(membership, dtype='<i4')
+    clusters = int(membership.max()) + 1 if len(membership) > 0 else 0
+    header = MEMBERSHIP_HEADER.pack(MEMBERSHIP_MAGIC, 1, 0, clusters, len(membership), len(table))
+    return header + table + membership.tobytes()
+
+def iter_binary_embedding(names: list, coordinates):
+    """ Encode an embedding in binary, in chunks: the header, the name table,
+        then the float32 coordinates of each row in turn """
+    coordinates = np.asarray(coordinates, dtype='<f4')
+    (rows, dimensions) = coordinates.shape
+    table = encode_names(names)
+    yield EMBEDDING_HEADER.pack(EMBEDDING_MAGIC, 1, 0, dimensions, rows, len(table))
+    yield table
+    for start in range(0, rows, CHUNK_ROWS):
+        yield coordinates[start:start+CHUNK_ROWS].tobytes()
+
+def get_content_type(f, default: str) -> str:
+    """ The content type of an encoded result, from its magic number.  The
+        file is left rewound """
+    magic = f.read(len(MEMBERSHIP_MAGIC))
+    f.seek(0)
+    if magic == MEMBERSHIP_MAGIC:
+        return MEMBERSHIP_TYPE
+    if magic == EMBEDDING_MAGIC:
+        return EMBEDDING_TYPE
+    return default
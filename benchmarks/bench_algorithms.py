@@ -0,0 +1,143 @@
+""" Benchmark every algorithm, stage by stage, on synthetic graphs.
+
+For each generator, size and algorithm a forked process reads the graph
+from JSON, as a client would upload it, and then runs the algorithm just as
+a worker does.  We report the seconds and the peak resident set size of each
+stage: parse (read_json_edges), build (the igraph graph), cluster (the
+algorithm), partition (the node names of each cluster) and encode (the
+result).  The peak RSS is reset at the start of each stage, so it is the
+most the process held during that stage, modules and graph included.
+
+A run that takes longer than the timeout is killed and reported as such,
+since fastgreedy and leadingeigenvector don't finish on the largest graphs.
+"""
+import getopt
+import io
+import json
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import falcon
+from falcon import testing
+import numpy as np
+# The workers import igraph as they start, so its import isn't part of any stage
+import igraph
+
+from api.algorithms.algorithms import ALGORITHMS
+from api.edgelist import read_json_edges
+from api.job import StatusWord
+from api.pool import get_peak_rss, reset_peak_rss
+import synthetic
+
+class StageStatus(StatusWord):
+    """ A status word of our own that also records the peak RSS of each phase """
+    def __init__(self):
+        super().__init__([0], 0)
+        self.peak_rss = {}
+
+    def end_phase(self) -> dict:
+        if self.phase is not None:
+            self.peak_rss[self.phase] = max(self.peak_rss.get(self.phase, 0), get_peak_rss())
+        reset_peak_rss()
+        return super().end_phase()
+
+def measure(algorithm: str, data: bytes, params: str, conn):
+    try:
+        status = StageStatus()
+        status['phase'] = 'parse'
+        edges = read_json_edges(io.BytesIO(data))
+        service = ALGORITHMS[algorithm](None)
+        service.name = algorithm
+        args = service.get_request_args(falcon.Request(testing.create_environ(query_string=params)))
+        args['edges'] = edges
+        args['initial_membership'] = None
+        result = {}
+        service.run(args, status, result)
+        status['phase'] = 'encode'
+        encoded = service.encode_result(args, result)
+        timings = status.end_phase()
+        if 'partitions' in result:
+            clusters = len(result['partitions'])
+        else:
+            clusters = max(result['membership'], default=-1) + 1
+        conn.send({'stages': {phase: {'seconds': seconds, 'peak_rss_bytes': status.peak_rss[phase]}
+                              for (phase, seconds) in timings.items()},
+                   'seconds': sum(timings.values()), 'clusters': clusters,
+                   'result_bytes': len(encoded)})
+    except Exception as e:
+        conn.send({'error': repr(e)})
+
+def run(algorithm: str, data: bytes, params: str, timeout: float) -> dict:
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=measure, args=(algorithm, data, params, child_conn))
+    proc.start()
+    if parent_conn.poll(timeout):
+        result = parent_conn.recv()
+    else:
+        proc.kill()
+        result = {'error': 'timeout'}
+    proc.join()
+    return result
+
+def usage():
+    print("bench_algorithms.py [-h][-g generator,...][-e edges,...][-a algorithm,...]"
+          "[-r repeat][-s seed][-t timeout][-o output]")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hg:e:a:r:s:t:o:",
+                                   ["help", "generators=", "edges=", "algorithms=", "repeat=",
+                                    "seed=", "timeout=", "output="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    generators = list(synthetic.GENERATORS)
+    sizes = [10000, 100000, 1000000]
+    algorithms = list(ALGORITHMS)
+    repeat = 1
+    seed = 1
+    timeout = 600
+    output = 'partitions'
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        elif o in ("-g", "--generators"):
+            generators = a.split(',')
+        elif o in ("-e", "--edges"):
+            sizes = [int(float(size)) for size in a.split(',')]
+        elif o in ("-a", "--algorithms"):
+            algorithms = a.split(',')
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        elif o in ("-s", "--seed"):
+            seed = int(a)
+        elif o in ("-t", "--timeout"):
+            timeout = float(a)
+        elif o in ("-o", "--output"):
+            output = a
+
+    multiprocessing.set_start_method('fork')
+    params = 'seed=%d&output=%s' % (seed, output)
+    results = []
+    for generator in generators:
+        for size in sizes:
+            graph = synthetic.make_graph(generator, size, seed=seed)
+            data = synthetic.encode_json(*graph)
+            nodes = len(np.union1d(graph[0], graph[1]))
+            for algorithm in algorithms:
+                print(generator, size, algorithm, file=sys.stderr)
+                runs = [run(algorithm, data, params, timeout) for i in range(repeat)]
+                best = min(runs, key=lambda r: r.get('seconds', float('inf')))
+                results.append(dict(best, generator=generator, algorithm=algorithm,
+                                    nodes=nodes, edges=len(graph[0]), json_bytes=len(data)))
+    print(json.dumps({'environment': synthetic.get_environment(), 'output': output,
+                      'seed': seed, 'results': results}))
+
+if __name__ == '__main__':
+    main()
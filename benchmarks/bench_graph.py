@@ -0,0 +1,97 @@
+""" Benchmark graph construction.
+
+Compares utils.get_graph against the original Graph.TupleList version on a
+random edge list of string node names, the way the clients send them.  Each
+builder runs in its own forked process so that the peak memory, measured as
+the growth of the maximum resident set size, covers only that build
+(including igraph's own allocations).
+"""
+import getopt
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import igraph as ig
+import api.utils as utils
+
+def tuplelist_graph(json_data: dict) -> ig.Graph:
+    """ The original get_graph """
+    edges = json_data['edges']
+    ncol = []
+    for edge in edges:
+        ncol.append((edge[0],edge[1],float(edge[2])))
+    return ig.Graph.TupleList(ncol,edge_attrs="weights")
+
+BUILDERS = {'tuplelist': tuplelist_graph, 'get_graph': utils.get_graph}
+
+def make_edges(nodes: int, edges: int, seed: int) -> dict:
+    rand = random.Random(seed)
+    return {'nodes': [],
+            'edges': [['node'+str(rand.randrange(nodes)), 'node'+str(rand.randrange(nodes)),
+                       str(rand.random())] for i in range(edges)]}
+
+def measure(builder: str, json_data: dict, conn):
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    graph = BUILDERS[builder](json_data)
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    conn.send({'seconds': elapsed, 'peak_rss_growth_bytes': rss*1024,
+               'vertices': graph.vcount(), 'edges': graph.ecount()})
+
+def run(builder: str, json_data: dict) -> dict:
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=measure, args=(builder, json_data, child_conn))
+    proc.start()
+    result = parent_conn.recv()
+    proc.join()
+    return result
+
+def usage():
+    print("bench_graph.py [-h][-n nodes][-e edges][-r repeat][-s seed]")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:e:r:s:",
+                                   ["help", "nodes=", "edges=", "repeat=", "seed="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    nodes = 100000
+    edges = 1000000
+    repeat = 3
+    seed = 1
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        elif o in ("-n", "--nodes"):
+            nodes = int(a)
+        elif o in ("-e", "--edges"):
+            edges = int(a)
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        elif o in ("-s", "--seed"):
+            seed = int(a)
+
+    multiprocessing.set_start_method('fork')
+    # get_graph factorizes with pandas, which api.utils imports on first use.
+    # Import it before the builders fork, so that it isn't timed in each one
+    utils.pd.factorize
+    json_data = make_edges(nodes, edges, seed)
+    results = {'nodes': nodes, 'edges': edges}
+    for builder in BUILDERS:
+        runs = [run(builder, json_data) for i in range(repeat)]
+        results[builder] = min(runs, key=lambda r: r['seconds'])
+    print(json.dumps(results))
+
+if __name__ == '__main__':
+    main()
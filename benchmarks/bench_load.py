@@ -0,0 +1,142 @@
+""" Benchmark the request path under concurrent load.
+
+Drives the Falcon app in-process from a number of client threads, each of
+which submits a job, waits for it with long polls and fetches its result,
+over and over.  We report the throughput and the p50/p99 latency of the
+submissions and of whole jobs (from submitting to having the result).  Each
+job gets a seed of its own, so none is answered from the result cache unless
+-C is given.  A 503 is retried after its Retry-After, and counted.
+"""
+import getopt
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic
+
+FINISHED = ('done', 'failed', 'timeout', 'oom')
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(fraction*(len(values)-1)))]
+
+def summarize(values: list) -> dict:
+    return {'p50': percentile(values, 0.5), 'p99': percentile(values, 0.99),
+            'max': max(values) if values else None}
+
+def run(client, algorithm: str, data: str, jobs: int, clients: int, cached: bool) -> dict:
+    submits = []
+    latencies = []
+    states = {}
+    counts = {'submitted': 0, 'rejected': 0}
+    lock = threading.Lock()
+
+    def job(index: int):
+        start = time.perf_counter()
+        params = {'data': data, 'seed': '1' if cached else str(index)}
+        while True:
+            submitted = time.perf_counter()
+            resp = client.simulate_post('/service/'+algorithm, params=params)
+            if resp.status_code != 503:
+                break
+            with lock:
+                counts['rejected'] += 1
+            time.sleep(float(resp.headers.get('Retry-After', 1)))
+        job_id = resp.json['job_id']
+        submit_seconds = time.perf_counter() - submitted
+        state = None
+        while state not in FINISHED:
+            state = client.simulate_get('/status/'+job_id, params={'wait': 30}).text
+        client.simulate_get('/fetch/'+job_id)
+        with lock:
+            submits.append(submit_seconds)
+            latencies.append(time.perf_counter() - start)
+            states[state] = states.get(state, 0) + 1
+
+    def loop():
+        while True:
+            with lock:
+                if counts['submitted'] >= jobs:
+                    return
+                index = counts['submitted']
+                counts['submitted'] += 1
+            job(index)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=loop) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'jobs_per_second': jobs/elapsed, 'states': states,
+            'rejected': counts['rejected'], 'submit_seconds': summarize(submits),
+            'job_seconds': summarize(latencies)}
+
+def usage():
+    print("bench_load.py [-h][-a algorithm][-g generator][-e edges][-n jobs][-c clients]"
+          "[-w workers][-s seed][-C]")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ha:g:e:n:c:w:s:C",
+                                   ["help", "algorithm=", "generator=", "edges=", "jobs=",
+                                    "clients=", "workers=", "seed=", "cached"])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    algorithm = 'leiden'
+    generator = 'sbm'
+    edges = 10000
+    jobs = 100
+    clients = 8
+    workers = os.cpu_count() or 1
+    seed = 1
+    cached = False
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        elif o in ("-a", "--algorithm"):
+            algorithm = a
+        elif o in ("-g", "--generator"):
+            generator = a
+        elif o in ("-e", "--edges"):
+            edges = int(float(a))
+        elif o in ("-n", "--jobs"):
+            jobs = int(a)
+        elif o in ("-c", "--clients"):
+            clients = int(a)
+        elif o in ("-w", "--workers"):
+            workers = int(a)
+        elif o in ("-s", "--seed"):
+            seed = int(a)
+        elif o in ("-C", "--cached"):
+            cached = True
+
+    data = synthetic.encode_json(*synthetic.make_graph(generator, edges, seed=seed)).decode()
+    with tempfile.TemporaryDirectory() as directory:
+        # The app reads its settings as it is created
+        os.environ.update(RESTAPI_POOL_WORKERS=str(workers),
+                          RESTAPI_JOB_STORE=os.path.join(directory, 'jobs.sqlite'),
+                          RESTAPI_RESULT_DIR=os.path.join(directory, 'results'),
+                          RESTAPI_METRICS_DIR=os.path.join(directory, 'metrics'))
+        from falcon import testing
+        from api.app import create_app
+        client = testing.TestClient(create_app())
+        results = run(client, algorithm, data, jobs, clients, cached)
+    print(json.dumps(dict(results, environment=synthetic.get_environment(), algorithm=algorithm,
+                          generator=generator, edges=edges, jobs=jobs, clients=clients,
+                          workers=workers, cached=cached)))
+
+if __name__ == '__main__':
+    main()
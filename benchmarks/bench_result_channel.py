@@ -0,0 +1,124 @@
+""" Benchmark the job status/result channel.
+
+Compares the old Manager().dict() proxies against the status word plus
+result file used by the worker pool, for a partition of a large network.
+Each run does what a job does: the child writes its status a few times and
+stores the partitions, then the parent polls the status and fetches the
+result.
+"""
+import getopt
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.job import StatusWord
+from api.pool import save_result
+import api.utils as utils
+
+def make_partitions(nodes: int, clusters: int) -> list:
+    partitions = [[] for i in range(clusters)]
+    for node in range(nodes):
+        partitions[node % clusters].append('node'+str(node))
+    return partitions
+
+def manager_child(status, result, partitions):
+    status['status'] = 'running'
+    result['partitions'] = partitions
+    status['status'] = 'done'
+
+def run_manager(partitions: list, polls: int) -> float:
+    manager = multiprocessing.Manager()
+    start = time.perf_counter()
+    status = manager.dict()
+    result = manager.dict()
+    proc = multiprocessing.Process(target=manager_child, args=(status, result, partitions))
+    proc.start()
+    proc.join()
+    for i in range(polls):
+        status['status']
+    # The old fetch_results: copy everything out of the proxies and encode it
+    json_data = {}
+    for key, value in status.items():
+        json_data[key] = value
+    for key, value in result.items():
+        json_data[key] = value
+    json.dumps(json_data)
+    elapsed = time.perf_counter() - start
+    manager.shutdown()
+    return elapsed
+
+def result_file_child(conn, status, result_dir, uid, partitions):
+    status['status'] = 'running'
+    result = {'partitions': partitions}
+    location = save_result(result_dir, uid, json.dumps(result).encode())
+    status['status'] = 'done'
+    conn.send(('done', uid, 'done', location))
+
+def run_result_file(partitions: list, polls: int, result_dir: str) -> float:
+    words = multiprocessing.RawArray('b', 1)
+    uid = uuid.uuid4()
+    start = time.perf_counter()
+    status = StatusWord(words, 0)
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=result_file_child,
+                                   args=(child_conn, status, result_dir, uid, partitions))
+    proc.start()
+    location = parent_conn.recv()[3]
+    proc.join()
+    for i in range(polls):
+        status['status']
+    # What fetch_results does with the file the worker left
+    with open(location, 'rb') as f:
+        utils.get_json_result({'status': 'done'}, f.read())
+    elapsed = time.perf_counter() - start
+    os.remove(location)
+    return elapsed
+
+def usage():
+    print("bench_result_channel.py [-h][-n nodes][-c clusters][-p polls][-r repeat]")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:c:p:r:",
+                                   ["help", "nodes=", "clusters=", "polls=", "repeat="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    nodes = 1000000
+    clusters = 1000
+    polls = 100
+    repeat = 3
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        elif o in ("-n", "--nodes"):
+            nodes = int(a)
+        elif o in ("-c", "--clusters"):
+            clusters = int(a)
+        elif o in ("-p", "--polls"):
+            polls = int(a)
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+
+    # Fork, so the partitions are inherited by the children just as the
+    # graph is inherited by a job
+    multiprocessing.set_start_method('fork')
+    partitions = make_partitions(nodes, clusters)
+    results = {'nodes': nodes, 'clusters': clusters, 'polls': polls}
+    results['manager'] = min(run_manager(partitions, polls) for i in range(repeat))
+    with tempfile.TemporaryDirectory() as result_dir:
+        results['result_file'] = min(run_result_file(partitions, polls, result_dir)
+                                     for i in range(repeat))
+    print(json.dumps(results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+""" Benchmark the startup of the WSGI app.
+
+Each run starts a fresh interpreter, the way a mod_wsgi daemon restart does,
+then creates the app, makes its first request and waits for the answer.  We
+report the time to create the app, the time to the first response (for a
+request that a worker has to run, until the job is done) and the resident
+set size of the web process afterwards.  Modules given with -i are imported
+before the app is created, to compare against importing them eagerly.
+"""
+import getopt
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+REQUESTS = ('services', 'leiden')
+
+CHILD = '''
+import json, os, sys, time
+start = time.perf_counter()
+for name in sys.argv[2:]:
+    __import__(name)
+from falcon import testing
+from api.app import create_app
+client = testing.TestClient(create_app())
+created = time.perf_counter()
+if sys.argv[1] == 'services':
+    client.simulate_get('/services')
+else:
+    edges = [['n'+str(i), 'n'+str((i*7+1) % 100), 1.0] for i in range(100)]
+    data = json.dumps({'nodes': [], 'edges': edges})
+    job_id = client.simulate_post('/service/leiden', params={'data': data}).json['job_id']
+    while client.simulate_get('/status/'+job_id, params={'wait': 30}).text not in ('done', 'failed'):
+        pass
+first = time.perf_counter()
+with open('/proc/self/statm') as f:
+    rss = int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+print(json.dumps({'create_seconds': created - start, 'first_response_seconds': first - start,
+                  'rss_bytes': rss,
+                  'loaded': [name for name in ('igraph', 'pandas', 'scanpy') if name in sys.modules]}))
+'''
+
+def run(request: str, imports: list, workers: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, PYTHONPATH=ROOT,
+                   RESTAPI_POOL_WORKERS=str(workers),
+                   RESTAPI_JOB_STORE=os.path.join(directory, 'jobs.sqlite'),
+                   RESTAPI_RESULT_DIR=os.path.join(directory, 'results'))
+        output = subprocess.run([sys.executable, '-c', CHILD, request] + imports, env=env,
+                                check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().splitlines()[-1])
+
+def usage():
+    print("bench_startup.py [-h][-r repeat][-w workers][-i module,...]")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hr:w:i:",
+                                   ["help", "repeat=", "workers=", "import="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    repeat = 3
+    workers = 2
+    imports = []
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        elif o in ("-w", "--workers"):
+            workers = int(a)
+        elif o in ("-i", "--import"):
+            imports = [name for name in a.split(',') if name]
+
+    results = {'imports': imports, 'workers': workers}
+    for request in REQUESTS:
+        runs = [run(request, imports, workers) for i in range(repeat)]
+        results[request] = min(runs, key=lambda r: r['first_response_seconds'])
+    print(json.dumps(results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+""" Synthetic graphs for the benchmarks.
+
+Each generator returns a simple graph (no self loops or repeated edges, so
+every algorithm can take it) as source and target arrays of node ids plus a
+weight array, drawn with numpy so that 10M edge graphs take seconds:
+
+* er - Erdős–Rényi, edges between uniformly chosen nodes
+* sbm - a stochastic block model, with most edges inside planted communities
+* powerlaw - Chung-Lu, with a power law degree distribution
+"""
+import os
+import platform
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The average degree when the number of nodes isn't given
+DEGREE = 20
+
+def erdos_renyi(nodes: int, edges: int, rng: np.random.Generator) -> tuple:
+    def sample(count):
+        return (rng.integers(nodes, size=count), rng.integers(nodes, size=count))
+    return simple_edges(nodes, edges, sample, rng)
+
+def sbm(nodes: int, edges: int, rng: np.random.Generator,
+        communities: int = None, mixing: float = 0.1) -> tuple:
+    """ A fraction mixing of the edges go between communities """
+    communities = communities or max(2, int(np.sqrt(nodes)/4))
+    size = nodes // communities
+    def sample(count):
+        sources = rng.integers(size*communities, size=count)
+        inside = (sources // size)*size + rng.integers(size, size=count)
+        targets = np.where(rng.random(count) < mixing, rng.integers(nodes, size=count), inside)
+        return (sources, targets)
+    return simple_edges(nodes, edges, sample, rng)
+
+def power_law(nodes: int, edges: int, rng: np.random.Generator, exponent: float = 2.5) -> tuple:
+    """ Each end of an edge is drawn in proportion to its node's expected
+        degree, which falls off as rank^(-1/(exponent-1)) """
+    expected = np.arange(1, nodes+1, dtype=np.float64) ** (-1/(exponent-1))
+    cumulative = np.cumsum(expected)
+    cumulative /= cumulative[-1]
+    def sample(count):
+        return (np.searchsorted(cumulative, rng.random(count)),
+                np.searchsorted(cumulative, rng.random(count)))
+    return simple_edges(nodes, edges, sample, rng)
+
+GENERATORS = {'er': erdos_renyi, 'sbm': sbm, 'powerlaw': power_law}
+
+def simple_edges(nodes: int, edges: int, sample, rng: np.random.Generator) -> tuple:
+    """ Draw edges until we have enough distinct ones, keeping them in the
+        order they were drawn """
+    sources = np.empty(0, dtype=np.int64)
+    targets = np.empty(0, dtype=np.int64)
+    edges = min(edges, nodes*(nodes-1)//2)
+    while len(sources) < edges:
+        (new_sources, new_targets) = sample(int((edges - len(sources))*1.2) + 16)
+        sources = np.concatenate((sources, new_sources))
+        targets = np.concatenate((targets, new_targets))
+        keep = sources != targets
+        (sources, targets) = (sources[keep], targets[keep])
+        keys = np.minimum(sources, targets)*nodes + np.maximum(sources, targets)
+        first = np.sort(np.unique(keys, return_index=True)[1])
+        (sources, targets) = (sources[first], targets[first])
+    return (sources[:edges], targets[:edges], rng.random(edges).round(4))
+
+def make_graph(generator: str, edges: int, nodes: int = None, seed: int = 1) -> tuple:
+    """ (sources, targets, weights) from one of the generators """
+    rng = np.random.default_rng(seed)
+    return GENERATORS[generator](nodes or max(2, edges*2 // DEGREE), edges, rng)
+
+def encode_json(sources, targets, weights) -> bytes:
+    """ The graph as a client would upload it: {"edges": [[name, name, weight], ...]} """
+    chunks = [b'{"nodes": [], "edges": [']
+    for start in range(0, len(sources), 1 << 16):
+        end = start + (1 << 16)
+        chunks.append((',' if start > 0 else '').encode())
+        chunks.append(','.join('["n%d","n%d",%s]' % edge
+                               for edge in zip(sources[start:end].tolist(),
+                                               targets[start:end].tolist(),
+                                               weights[start:end].tolist())).encode())
+    chunks.append(b']}')
+    return b''.join(chunks)
+
+def get_environment() -> dict:
+    """ What the results were measured on, so that they can be compared
+        across versions """
+    environment = {'python': platform.python_version(), 'machine': platform.machine(),
+                   'cpus': os.cpu_count()}
+    try:
+        environment['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                               check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    for module in ('igraph', 'numpy', 'falcon'):
+        try:
+            environment[module] = __import__(module).__version__
+        except (ImportError, AttributeError):
+            pass
+    return environment
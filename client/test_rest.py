@@ -1,6 +1,7 @@
 """ Test module """
 import getopt
 import json
+import struct
 import time
 import requests
 import sys
@@ -10,7 +11,29 @@ import igraph as ig
 LOCAL_PATH = 'http://localhost:8000/'
 PROD_PATH = 'http://webservices.rbvi.ucsf.edu/rest/api/v1/'
 
-def test_service(input_file:str, server:str, service:str):
+def encode_binary_edges(edges: list) -> bytes:
+    """ Encode the edges in the server's binary edge list format (see
+        api/edgelist.py), which it can read without parsing """
+    ids = {}
+    names = []
+    sources = []
+    targets = []
+    weights = []
+    for edge in edges:
+        for name, column in ((edge[0], sources), (edge[1], targets)):
+            if name not in ids:
+                ids[name] = len(names)
+                names.append(name)
+            column.append(ids[name])
+        weights.append(float(edge[2]) if len(edge) > 2 else 1.0)
+    table = b''.join(name.encode('utf-8')+b'\0' for name in names)
+    table += b'\0'*(-len(table) % 8)
+    count = len(edges)
+    return (struct.pack('<4sIIIQQ', b'RBEL', 1, 0, len(names), count, len(table)) + table +
+            struct.pack('<%di' % count, *sources) + struct.pack('<%di' % count, *targets) +
+            struct.pack('<%df' % count, *weights))
+
+def test_service(input_file:str, server:str, service:str, binary:bool = False):
 
     # Read in our data
     f = open(input_file, "r")
@@ -19,38 +42,41 @@ def test_service(input_file:str, server:str, service:str):
         line2 = line.strip()
         edges.append(line2.split(","))
 
-    data = {"nodes":[], "edges":edges}
-    json_data = json.dumps(data)
+    if binary:
+        files = dict(data=('data', encode_binary_edges(edges), 'application/x-edgelist'))
+    else:
+        data = {"nodes":[], "edges":edges}
+        files = dict(data=json.dumps(data))
 
     if service == "leiden":
         response = requests.post(
             server+'service/leiden?objective_function=modularity&iterations=4',
-            files=dict(data=json_data)
+            files=files
         )
     elif service == "fastgreedy":
         response = requests.post(
             server+'service/fastgreedy',
-            files=dict(data=json_data)
+            files=files
         )
     elif service == "infomap":
         response = requests.post(
             server+'service/infomap',
-            files=dict(data=json_data)
+            files=files
         )
     elif service == "labelpropagation":
         response = requests.post(
             server+'service/labelpropagation',
-            files=dict(data=json_data)
+            files=files
         )
     elif service == "leadingeigenvector":
         response = requests.post(
             server+'service/leadingeigenvector',
-            files=dict(data=json_data)
+            files=files
         )
     elif service == "multilevel":
         response = requests.post(
             server+'service/multilevel',
-            files=dict(data=json_data)
+            files=files
         )
     else:
         print("Unknown service: "+service)
@@ -60,22 +86,64 @@ def test_service(input_file:str, server:str, service:str):
     resp = response.json()
     print ('uuid = '+resp['job_id'])
     uuid = resp['job_id']
-    status = None
-
-    while status != 'done':
-        time.sleep(2)
-        response = requests.get(server+'status/'+uuid)
-        status = response.text
+    wait_for_job(server, uuid)
 
     response = requests.get(server+'fetch/'+uuid)
     print(response.text)
 
+def wait_for_job(server: str, uuid: str) -> str:
+    """ Wait for a job to finish, returning its state.  Each status request
+        waits on the server until the job changes state """
+    status = None
+    while status not in ('done', 'failed', 'timeout', 'oom'):
+        response = requests.get(server+'status/'+uuid, params={'wait': 30})
+        status = response.text
+    return status
+
+def test_warm_start(server: str):
+    """ Warm start leiden from a graph whose node ids are JSON numbers, and
+        check that the changes were applied to the same nodes """
+    edges = [[1, 2, 1], [2, 3, 1], [3, 1, 1], [4, 5, 1], [5, 6, 1], [6, 4, 1], [3, 4, 1]]
+    response = requests.post(server+'service/leiden?seed=1&keep_graph=true',
+                             files=dict(data=json.dumps({"edges": edges})))
+    first = response.json()['job_id']
+    print('first job '+first+': '+wait_for_job(server, first))
+
+    delta = {"edges": [[6, 7, 1], [7, 4, 1]], "removed": [[3, 4]]}
+    response = requests.post(server+'service/leiden?seed=1&output=membership&previous='+first,
+                             files=dict(data=json.dumps(delta)))
+    print(response.text)
+    second = response.json()['job_id']
+    print('warm started job '+second+': '+wait_for_job(server, second))
+    result = requests.get(server+'fetch/'+second).json()
+    print(json.dumps(result))
+    if result.get('nodes') != [1, 2, 3, 4, 5, 6, 7] or result['stats']['edges'] != 8:
+        print('FAILED: expected nodes 1 to 7 and 8 edges')
+        sys.exit(1)
+    print('passed')
+
+def test_oversized_batch(server: str):
+    """ Check that a batch too large for the job queue is refused outright,
+        rather than with a 503 that would have the client retry forever """
+    items = [{"algorithm": "leiden", "params": {"seed": seed}} for seed in range(100000)]
+    response = requests.post(server+'batch',
+                             files=dict(data=json.dumps({"edges": [["a", "b", 1]]}),
+                                        items=json.dumps(items)))
+    print(response.status_code, response.text)
+    if response.status_code != 413:
+        print('FAILED: expected 413')
+        sys.exit(1)
+    print('passed')
+
 def usage():
-    print("test_rest.py [-h][-i input][-s server][-a service]")
+    print("test_rest.py [-h][-b][-w][-o][-i input][-s server][-a service]")
+    print("    -b sends the edges in the binary edge list format rather than JSON")
+    print("    -w checks that leiden warm starts from a graph with numeric node ids")
+    print("    -o checks that a batch too large for the job queue is refused")
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hi:s:a:", ["help", "input=", "server=", "service="])
+        opts, args = getopt.getopt(sys.argv[1:], "hbwoi:s:a:", ["help", "binary", "warm", "oversized", "input=", "server=", "service="])
     except getopt.GetoptError as err:
         print(err)
         usage()
@@ -84,10 +152,19 @@ def main():
     input_file = None
     server = PROD_PATH
     service = "leiden"
+    binary = False
+    warm = False
+    oversized = False
     for o, a in opts:
         if o in ("-h", "--help"):
             usage()
             sys.exit(0)
+        elif o in ("-b", "--binary"):
+            binary = True
+        elif o in ("-w", "--warm"):
+            warm = True
+        elif o in ("-o", "--oversized"):
+            oversized = True
         elif o in ("-i", "--input"):
             input_file = a
         elif o in ("-s", "--server"):
@@ -100,11 +177,18 @@ def main():
         elif o in ("-a", "--service"):
             service = a
 
+    if warm:
+        test_warm_start(server)
+        return
+    if oversized:
+        test_oversized_batch(server)
+        return
+
     if input_file == None:
         print("Input file must be specified")
         sys.exit(2)
 
-    test_service(input_file, server, service)
+    test_service(input_file, server, service, binary)
 
 if __name__ == '__main__':
     main()